@@ -0,0 +1,267 @@
+# Binary columnar candle storage
+import os
+import json
+import shutil
+import pandas as pd
+import numpy as np
+
+# raw candle format written by omegaforex.download_data
+HEADERS = ['date', 'complete', 'open', 'high', 'low', 'close', 'volume']
+
+MY_DTYPES = {
+    'date': 'str',
+    'complete': 'bool',
+    'open': 'float',
+    'high': 'float',
+    'low': 'float',
+    'close': 'float',
+    'volume': 'float'
+}
+
+# typed columns of the binary store - time is int64 epoch seconds
+COLUMNS = {
+    'time': np.int64,
+    'complete': np.bool_,
+    'open': np.float64,
+    'high': np.float64,
+    'low': np.float64,
+    'close': np.float64,
+    'volume': np.int32,
+}
+
+
+def is_store(path):
+    """
+    Returns True if path is a binary candle store (a directory of .npy columns) rather than a CSV.
+    """
+    return os.path.isdir(path) and os.path.exists(f'{path}/meta.json')
+
+
+class CandleWriter:
+    """
+    Writes candle responses from OandaAPI as typed columns - one .npy per column in a directory - instead of formatting every candle into a CSV line.
+
+    Columns are appended to raw files while downloading and turned into .npy files on close. Everything is written to path.tmp and renamed to path at the end, so a failed download never leaves a half written store.
+
+    ARGS:
+        path: <string> - the store directory, example: ./raw_data/GBP_USD_H1_2016-01-01_2018-01-01
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f'{path}.tmp'
+        self.rows = 0
+
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+        self.files = {c: open(f'{self.tmp_path}/{c}.bin', 'wb') for c in COLUMNS}
+
+    def write_candles(self, r, after=None):
+        """
+        Same as omegaforex.cnv but appends to the columns. Returns the time of the last candle written.
+        """
+        candles = [c for c in r.get('candles') if after is None or c.get('time')[0:19] > after]
+        if not candles:
+            return after
+
+        columns = {
+            'time': np.array([c['time'][0:19] for c in candles], dtype='datetime64[s]').view(np.int64),
+            'complete': [c['complete'] for c in candles],
+            'open': [c['mid']['o'] for c in candles],
+            'high': [c['mid']['h'] for c in candles],
+            'low': [c['mid']['l'] for c in candles],
+            'close': [c['mid']['c'] for c in candles],
+            'volume': [c['volume'] for c in candles],
+        }
+
+        for c, dtype in COLUMNS.items():
+            self.files[c].write(np.asarray(columns[c], dtype=dtype).tobytes())
+
+        self.rows += len(candles)
+
+        return candles[-1]['time'][0:19]
+
+    def close(self):
+        """
+        Turns the raw columns into .npy files and moves the store into place.
+        """
+        for c, dtype in COLUMNS.items():
+            self.files[c].close()
+            raw = np.fromfile(f'{self.tmp_path}/{c}.bin', dtype=dtype)
+            np.save(f'{self.tmp_path}/{c}.npy', raw)
+            os.remove(f'{self.tmp_path}/{c}.bin')
+
+        with open(f'{self.tmp_path}/meta.json', 'w') as f:
+            json.dump({'rows': self.rows, 'columns': {c: np.dtype(d).name for c, d in COLUMNS.items()}}, f)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Drops everything written so far.
+        """
+        for f in self.files.values():
+            f.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def save_candles(df_, path):
+    """
+    Writes a candle dataframe (as returned by load_candles) to a binary candle store.
+
+    ARGS:
+        df_: <pandas dataframe object> - date, complete, open, high, low, close, volume
+        path: <string> - the store directory
+    """
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    columns = {
+        'time': df_['date'].values.astype('datetime64[s]').view(np.int64),
+        'complete': df_['complete'].values,
+        'open': df_['open'].values,
+        'high': df_['high'].values,
+        'low': df_['low'].values,
+        'close': df_['close'].values,
+        'volume': df_['volume'].values,
+    }
+
+    for c, dtype in COLUMNS.items():
+        np.save(f'{tmp_path}/{c}.npy', np.asarray(columns[c], dtype=dtype))
+
+    with open(f'{tmp_path}/meta.json', 'w') as f:
+        json.dump({'rows': len(df_), 'columns': {c: np.dtype(d).name for c, d in COLUMNS.items()}}, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+
+def convert_candles(file, path=None):
+    """
+    Converts a CSV written by download_data into a binary candle store next to it.
+
+    ARGS:
+        file: <string> - path to the CSV
+        path: <string> - the store directory, defaults to the CSV path without .csv
+
+    RETURNS:
+        the store directory
+    """
+    path = path or os.path.splitext(file)[0]
+    save_candles(load_candles(file), path)
+
+    return path
+
+
+def to_epoch(t):
+    """
+    Converts a date, datetime, timestamp or string into int64 epoch seconds - the time column of a binary candle store.
+    """
+    return int(pd.Timestamp(t).to_datetime64().astype('datetime64[s]').view(np.int64))
+
+
+def open_candles(path, start=None, end=None):
+    """
+    Memory-maps the columns of a binary candle store and returns the [start, end) time range as numpy views. The start and end rows are found by binary search on the time column, so only a few pages of it are ever read - the rest of the file is never touched.
+
+    ARGS:
+        path: <string> - the store directory
+        start: <date, datetime or string> - first candle time to return (inclusive), None means the first candle
+        end: <date, datetime or string> - last candle time to return (exclusive), None means after the last candle
+
+    RETURNS:
+        <dict> - column name: read-only numpy view, time is int64 epoch seconds
+    """
+    columns = {c: np.load(f'{path}/{c}.npy', mmap_mode='r') for c in COLUMNS}
+    time = columns['time']
+
+    # binary search on the time index
+    lo = 0 if start is None else int(np.searchsorted(time, to_epoch(start), side='left'))
+    hi = len(time) if end is None else int(np.searchsorted(time, to_epoch(end), side='left'))
+
+    return {c: values[lo:hi] for c, values in columns.items()}
+
+
+def load_candles(path, start=None, end=None, as_frame=True):
+    """
+    This is the one loader for raw candles - a CSV written by download_data or a binary candle store - replacing the pd.read_csv(file, names=headers, dtype=my_dtypes, parse_dates=my_parse_dates) cell of every notebook.
+
+    Binary candle stores are memory-mapped and sliced with open_candles, so pulling one week out of ten years of M1 data only reads that week. A CSV has no index and is always read whole before slicing - convert it once with convert_candles.
+
+    ARGS:
+        path: <string> - path to the CSV or the store directory
+        start: <date, datetime or string> - first candle time to return (inclusive), None means the first candle
+        end: <date, datetime or string> - last candle time to return (exclusive), None means after the last candle
+        as_frame: <boolean> - if False, a store returns the dict of numpy views of open_candles instead of a dataframe (no copy at all)
+
+    RETURNS:
+        <pandas dataframe object> - date, complete, open, high, low, close, volume
+    """
+    if not is_store(path):
+        df = pd.read_csv(path, names=HEADERS, dtype=MY_DTYPES, parse_dates=['date'])
+
+        if start is not None:
+            df = df[df['date'] >= pd.Timestamp(start)]
+        if end is not None:
+            df = df[df['date'] < pd.Timestamp(end)]
+
+        return df.reset_index(drop=True) if start is not None or end is not None else df
+
+    columns = open_candles(path, start=start, end=end)
+
+    if not as_frame:
+        return columns
+
+    return pd.DataFrame({
+        'date': columns['time'].view('datetime64[s]'),
+        'complete': columns['complete'],
+        'open': columns['open'],
+        'high': columns['high'],
+        'low': columns['low'],
+        'close': columns['close'],
+        'volume': columns['volume'],
+    })
+
+
+def iter_candles(path, columns=('open', 'close'), start=None, end=None, chunksize=100000):
+    """
+    Streams the candles of a CSV or binary candle store one at a time, chunksize rows in memory at most - for consumers that never need the whole history, like omega_simulate.StreamBacktest.
+
+    ARGS:
+        path: <string> - path to the CSV or the store directory
+        columns: <tuple> - the columns of every candle, in order
+        start: <date, datetime or string> - first candle time to return (inclusive), None means the first candle
+        end: <date, datetime or string> - last candle time to return (exclusive), None means after the last candle
+        chunksize: <int> - how many rows are read at a time
+
+    YIELDS:
+        <tuple> - one value per column
+    """
+    if is_store(path):
+        store = open_candles(path, start=start, end=end)
+        for a in range(0, len(store['time']), chunksize):
+            yield from zip(*[store[c][a:a + chunksize].tolist() for c in columns])
+        return
+
+    for chunk in pd.read_csv(path, names=HEADERS, dtype=MY_DTYPES, parse_dates=['date'], chunksize=chunksize):
+        if start is not None:
+            chunk = chunk[chunk['date'] >= pd.Timestamp(start)]
+        if end is not None:
+            chunk = chunk[chunk['date'] < pd.Timestamp(end)]
+
+        yield from zip(*[chunk[c].tolist() for c in columns])
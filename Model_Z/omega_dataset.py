@@ -0,0 +1,185 @@
+# Streaming candlestick image dataset - windows are rendered on the fly instead of read from disk
+import collections
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+from omegacandlestick import label_windows, window_image, render_windows, new_canvas, quote_array
+
+
+# worker side of CandleDataset.batches
+dataset_state = {}
+
+
+def dataset_init(shm_name, shape, window_size, candle_size, renderer):
+    """
+    Pool initializer - attaches every worker to the shared memory block holding the quotes, and gives it its own figure.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    dataset_state['shm'] = shm
+    dataset_state['quotes'] = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    dataset_state['window_size'] = window_size
+    dataset_state['candle_size'] = candle_size
+    dataset_state['renderer'] = renderer
+    dataset_state['canvas'] = new_canvas() if renderer == 'matplotlib' else None
+
+
+def render_batch(quotes, starts, window_size, candle_size, renderer, canvas):
+    """
+    Renders the windows starting at starts into one (len(starts), H, W, 3) uint8 array - in one render_windows call for the raster renderer.
+    """
+    if renderer == 'raster':
+        return render_windows(quotes, starts, window_size, candle_size)
+
+    images = None
+    for k, start in enumerate(starts):
+        image = window_image(quotes[start:start + window_size], candle_size, renderer, canvas)
+        if images is None:
+            images = np.empty((len(starts),) + image.shape, dtype=np.uint8)
+        images[k] = image
+
+    return images
+
+
+def dataset_worker(starts):
+    """
+    Renders one batch on the shared quotes.
+    """
+    return render_batch(dataset_state['quotes'], starts, dataset_state['window_size'], dataset_state['candle_size'], dataset_state['renderer'], dataset_state['canvas'])
+
+
+class CandleDataset:
+    """
+    A dataset of labeled candlestick windows that are never written to disk - every window is rendered when it is asked for, with the same labels (label_windows) and pixels (window_image) as save_images_multi / save_images_binary. Changing the window size or the thresholds costs nothing but a new CandleDataset.
+
+    It follows the map-style dataset protocol of torch (len and random access by window index), so it can be handed to a torch DataLoader as is. batches() is the loader of its own: windows are rendered in worker processes reading the quotes from shared memory, with at most prefetch batches in flight, so memory stays bounded whatever the length of the series.
+
+    Shuffling is seeded by (seed, epoch) - call set_epoch at the start of every epoch for a new order that is still reproducible.
+
+    ARGS:
+        df_: <pandas dataframe object> - date, open, high, low, close - date as datetime or float (mdates.date2num)
+        buy_percentage: <float> - see save_images_multi
+        sell_percentage: <float> - see save_images_multi
+        window_size: <int> - how many timesteps will a window consist of
+        target_size: <int> - how far off are we labeling an projecting
+        candle_size: <float> - the size of each candle
+        binary: <boolean> - if True, holds are discarded (save_images_binary)
+        renderer: <string> - 'matplotlib' or 'raster', see save_window
+        seed: <int> - seed of the shuffling
+    """
+    def __init__(self, df_, buy_percentage, sell_percentage, window_size=15, target_size=3, candle_size=0.022, binary=False, renderer='raster', seed=0):
+        # one (N, 5) quotes array - every window is a view on it
+        self.quotes = quote_array(df_)
+        self.row_index = df_.index.values
+
+        self.window_size = window_size
+        self.candle_size = candle_size
+        self.renderer = renderer
+        self.seed = seed
+        self.epoch = 0
+        self.canvas = None
+
+        self.starts, self.labels = label_windows(self.quotes[:, 1], self.quotes[:, 4], window_size, target_size, buy_percentage, sell_percentage, binary=binary)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        """
+        Renders window i in this process.
+
+        RETURNS:
+            image, label - (H, W, 3) uint8 and a code into omega_shards.LABELS
+        """
+        if self.renderer == 'matplotlib' and self.canvas is None:
+            self.canvas = new_canvas()
+
+        start = self.starts[i]
+        image = window_image(self.quotes[start:start + self.window_size], self.candle_size, self.renderer, self.canvas)
+
+        return image, self.labels[i]
+
+    def __getstate__(self):
+        # figures are not pickled - every torch worker makes its own
+        state = self.__dict__.copy()
+        state['canvas'] = None
+        return state
+
+    def set_epoch(self, epoch):
+        """
+        Sets the epoch the next shuffled order is seeded with.
+        """
+        self.epoch = epoch
+
+    def order(self, shuffle=True):
+        """
+        Returns the window indices of one epoch - a permutation seeded by (seed, epoch) if shuffle.
+        """
+        if not shuffle:
+            return np.arange(len(self))
+
+        return np.random.default_rng((self.seed, self.epoch)).permutation(len(self))
+
+    def batches(self, batch_size=64, shuffle=True, processes=None, prefetch=4):
+        """
+        Streams one epoch of batches, rendered in worker processes. Batches come back in order, and no more than prefetch of them are rendered ahead of the consumer.
+
+        ARGS:
+            batch_size: <int> - windows per batch
+            shuffle: <boolean> - if True, the windows are shuffled with order
+            processes: <int> - number of worker processes, defaults to the number of cores - 0 renders in this process
+            prefetch: <int> - how many batches may be in flight at once
+
+        YIELDS:
+            images, labels, index - (B, H, W, 3) uint8, label codes and the global row of every window start
+        """
+        order = self.order(shuffle)
+        batches = [order[a:a + batch_size] for a in range(0, len(order), batch_size)]
+
+        if processes == 0:
+            if self.renderer == 'matplotlib' and self.canvas is None:
+                self.canvas = new_canvas()
+            for ids in batches:
+                starts = self.starts[ids]
+                yield render_batch(self.quotes, starts, self.window_size, self.candle_size, self.renderer, self.canvas), self.labels[ids], self.row_index[starts]
+            return
+
+        processes = processes or mp.cpu_count()
+
+        # quotes in shared memory - workers never get a copy
+        shm = shared_memory.SharedMemory(create=True, size=self.quotes.nbytes)
+        shared = np.ndarray(self.quotes.shape, dtype=np.float64, buffer=shm.buf)
+        shared[:] = self.quotes
+
+        try:
+            with mp.Pool(processes, initializer=dataset_init, initargs=(shm.name, self.quotes.shape, self.window_size, self.candle_size, self.renderer)) as pool:
+                pending = collections.deque()
+                batches = iter(batches)
+
+                # keeping prefetch batches in flight
+                for ids in batches:
+                    pending.append((ids, pool.apply_async(dataset_worker, (self.starts[ids],))))
+                    if len(pending) >= prefetch:
+                        break
+
+                while pending:
+                    ids, result = pending.popleft()
+                    images = result.get()
+
+                    ids_next = next(batches, None)
+                    if ids_next is not None:
+                        pending.append((ids_next, pool.apply_async(dataset_worker, (self.starts[ids_next],))))
+
+                    yield images, self.labels[ids], self.row_index[self.starts[ids]]
+        finally:
+            del shared
+            shm.close()
+            shm.unlink()
+
+    def __iter__(self):
+        """
+        Iterates one shuffled epoch window by window - see batches.
+        """
+        for images, labels, index in self.batches():
+            for image, label in zip(images, labels):
+                yield image, label
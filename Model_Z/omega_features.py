@@ -0,0 +1,220 @@
+# Persistent feature store for computed change matrices
+import os
+import json
+import shutil
+import hashlib
+import pandas as pd
+import numpy as np
+
+from omega_analysis import return_open_close_range_change
+from omega_candles import load_candles
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    Returns the sha1 hex digest of a file, read in blocks so large minute files never sit in memory. A binary candle store (directory) is hashed over all of its files.
+
+    ARGS:
+        path: <string> path to the file or directory
+        block_size: <int> how many bytes are read at a time
+    """
+    sha = hashlib.sha1()
+    files = [f'{path}/{name}' for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+
+    for file in files:
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+
+    return sha.hexdigest()
+
+
+def source_hash(path, store_path):
+    """
+    Returns the hash of a raw candle file. Hashes are remembered in the store by (size, modification time) so an unchanged file is only hashed once.
+
+    ARGS:
+        path: <string> path to the raw candle file or binary candle store
+        store_path: <string> root directory of the feature store
+    """
+    files = [f'{path}/{name}' for name in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+    stamp = ';'.join(f'{os.stat(f).st_size}:{os.stat(f).st_mtime_ns}' for f in files)
+
+    hashes_file = f'{store_path}/hashes.json'
+    hashes = {}
+    if os.path.exists(hashes_file):
+        with open(hashes_file) as f:
+            hashes = json.load(f)
+
+    entry = hashes.get(os.path.abspath(path))
+    if entry is not None and entry['stamp'] == stamp:
+        return entry['hash']
+
+    digest = file_hash(path)
+    hashes[os.path.abspath(path)] = {'stamp': stamp, 'hash': digest}
+
+    tmp_file = f'{hashes_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(hashes, f)
+    os.replace(tmp_file, hashes_file)
+
+    return digest
+
+
+def parse_raw_name(path):
+    """
+    Splits a raw file name written by download_data into (instrument, granularity, start_date, end_date).
+
+    Example: GBP_USD_H1_2016-01-01_2018-01-01.csv -> ('GBP_USD', 'H1', '2016-01-01', '2018-01-01')
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    parts = name.split('_')
+
+    if len(parts) < 4:
+        raise ValueError(f'cannot parse instrument, granularity and dates from: {name}')
+
+    return '_'.join(parts[:-3]), parts[-3], parts[-2], parts[-1]
+
+
+# layout of the stored entries - bumped when it changes so old entries are recomputed
+STORE_VERSION = 2
+
+
+def changes_key(instrument, granularity, start_date, end_date, horizons, source, dtype):
+    """
+    Returns the store key of a change matrix: a hash of (instrument, granularity, date range, horizon set, source file hash, dtype, store version).
+    """
+    key = json.dumps({
+        'version': STORE_VERSION,
+        'instrument': instrument,
+        'granularity': granularity,
+        'start_date': str(start_date),
+        'end_date': str(end_date),
+        'horizons': [int(h) for h in horizons],
+        'source': source,
+        'dtype': np.dtype(dtype).name,
+    }, sort_keys=True)
+
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def build_changes(raw_file, range_, dtype=np.float64):
+    """
+    Reads a raw candle file and computes its change matrix - the same table 2_Data_Analysis writes to changes_1hr_USDGBP.csv.
+
+    ARGS:
+        raw_file: <string> path to the raw candle csv or binary candle store
+        range_: <int> max range
+        dtype: <numpy dtype> dtype of the change matrix
+
+    RETURNS:
+        date, open, close, changes
+    """
+    df = load_candles(raw_file)
+    changes = return_open_close_range_change(df, range_=range_, dtype=dtype)
+
+    return df['date'].values, df['open'].values, df['close'].values, changes.values
+
+
+def save_changes(entry_path, meta, date, open_, close, changes):
+    """
+    Writes a change matrix to the store as one .npy per part. The prices (open, close) are always kept float64, only the change columns are saved in the dtype of changes. Both are saved column-major so each column is contiguous on disk.
+
+    The entry is written to a temporary directory first and renamed into place, so readers never see half an entry.
+    """
+    tmp_path = f'{entry_path}.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    # (columns, rows) - open and close, then one row per horizon
+    prices = np.empty((2, changes.shape[0]), dtype=np.float64)
+    prices[0] = open_
+    prices[1] = close
+    values = np.ascontiguousarray(changes.T)
+
+    np.save(f'{tmp_path}/date.npy', date.astype('datetime64[ns]').view(np.int64))
+    np.save(f'{tmp_path}/prices.npy', prices)
+    np.save(f'{tmp_path}/values.npy', values)
+
+    with open(f'{tmp_path}/meta.json', 'w') as f:
+        json.dump(meta, f)
+
+    if os.path.exists(entry_path):
+        shutil.rmtree(entry_path)
+    os.replace(tmp_path, entry_path)
+
+
+def open_changes(entry_path):
+    """
+    Memory-maps a stored change matrix and returns it as a dataframe with the columns of changes_1hr_USDGBP.csv: date, open, close, '1' ... 'range_'.
+
+    The float columns are views on the memory-mapped files - nothing is read until it is used. open and close are float64 whatever the dtype of the changes. The dataframe is read-only.
+    """
+    with open(f'{entry_path}/meta.json') as f:
+        meta = json.load(f)
+
+    date = np.load(f'{entry_path}/date.npy', mmap_mode='r')
+    prices = np.load(f'{entry_path}/prices.npy', mmap_mode='r')
+    values = np.load(f'{entry_path}/values.npy', mmap_mode='r')
+
+    # values.T is (rows, columns) in fortran order - pandas keeps it as a single block without copying
+    df = pd.DataFrame(values.T, columns=[str(h) for h in meta['horizons']], copy=False)
+    df.insert(0, 'close', prices[1])
+    df.insert(0, 'open', prices[0])
+    df.insert(0, 'date', pd.to_datetime(np.asarray(date).view('datetime64[ns]')))
+
+    return df
+
+
+def load_changes(raw_file, range_=48, store_path='./post_processing/feature_store', instrument=None, granularity=None, start_date=None, end_date=None, dtype=np.float64):
+    """
+    This function will return the change matrix of a raw candle file from the feature store, computing and storing it only if the raw candles changed (or it was never computed). This replaces reading ./post_processing/data_fluc/changes_1hr_USDGBP.csv
+
+    ARGS:
+        raw_file: <string> path to the raw candle csv or binary candle store written by download_data
+        range_: <int> max range - horizons 1 ... range_
+        store_path: <string> root directory of the feature store
+        instrument: <string> example: "GBP_USD" - parsed from the raw file name if not given
+        granularity: <string> example: "H1" - parsed from the raw file name if not given
+        start_date: <string or date> parsed from the raw file name if not given
+        end_date: <string or date> parsed from the raw file name if not given
+        dtype: <numpy dtype> np.float64 or np.float32
+
+    RETURNS:
+        <pandas.DataFrame> date, open, close, '1' ... 'range_' - memory-mapped
+    """
+    if None in (instrument, granularity, start_date, end_date):
+        parsed = parse_raw_name(raw_file)
+        instrument = instrument or parsed[0]
+        granularity = granularity or parsed[1]
+        start_date = start_date or parsed[2]
+        end_date = end_date or parsed[3]
+
+    os.makedirs(store_path, exist_ok=True)
+
+    horizons = list(range(1, range_ + 1))
+    source = source_hash(raw_file, store_path)
+    key = changes_key(instrument, granularity, start_date, end_date, horizons, source, dtype)
+    entry_path = f'{store_path}/{instrument}_{granularity}_{key}'
+
+    # computing only on a miss
+    if not os.path.exists(f'{entry_path}/meta.json'):
+        print(f'Computing changes for: {raw_file}')
+
+        date, open_, close, changes = build_changes(raw_file, range_, dtype=dtype)
+
+        meta = {
+            'instrument': instrument,
+            'granularity': granularity,
+            'start_date': str(start_date),
+            'end_date': str(end_date),
+            'horizons': horizons,
+            'source': source,
+            'source_file': os.path.abspath(raw_file),
+            'dtype': np.dtype(dtype).name,
+            'rows': len(date),
+        }
+        save_changes(entry_path, meta, date, open_, close, changes)
+
+    return open_changes(entry_path)
@@ -0,0 +1,142 @@
+# Risk metrics over equity curves - one row per parameter set, no loop over parameter sets
+import numpy as np
+import pandas as pd
+
+# H1 forex candles: 24 hours x 5 days x 52 weeks
+PERIODS_PER_YEAR = 24 * 5 * 52
+
+
+def bar_returns(equity):
+    """
+    Returns the simple return of every bar of one or many equity curves, shape (params, bars - 1).
+    """
+    equity = np.atleast_2d(np.asarray(equity, dtype=np.float64))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.diff(equity, axis=1) / equity[:, :-1]
+
+
+def drawdowns(equity):
+    """
+    Returns the drawdown of every bar (equity / running peak - 1, so 0 or negative) and the max drawdown duration of every row - the longest run of bars spent under a previous peak.
+
+    RETURNS:
+        drawdown, max_drawdown_duration - shapes (params, bars) and (params,)
+    """
+    equity = np.atleast_2d(np.asarray(equity, dtype=np.float64))
+    bars = np.arange(equity.shape[1])
+
+    peak = np.maximum.accumulate(equity, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        drawdown = equity / peak - 1
+
+    # bars since the last bar at a peak - its max is the longest time under water
+    underwater = equity < peak
+    last_peak = np.maximum.accumulate(np.where(underwater, -1, bars), axis=1)
+    duration = (bars - last_peak).max(axis=1)
+
+    return drawdown, duration
+
+
+def trade_returns(equity, position):
+    """
+    Splits the bars of every row into trades - runs of bars where the position is open - and returns the return of every trade, from the equity on the bar before it opens to the equity on the bar it is closed (the last bar if it is still open). Costs are included since they are taken out of the equity.
+
+    ARGS:
+        equity: <numpy.array> equity curves, shape (params, bars)
+        position: <numpy.array> True on the bars a position is held after trading, shape (params, bars)
+
+    RETURNS:
+        rows, returns - the row of every trade and its return, in row order
+    """
+    equity = np.atleast_2d(np.asarray(equity, dtype=np.float64))
+    position = np.atleast_2d(np.asarray(position, dtype=bool))
+    p, n = position.shape
+
+    # padding with flat bars so every trade has an entry and an exit edge
+    padded = np.zeros((p, n + 2), dtype=bool)
+    padded[:, 1:-1] = position
+    edges = np.diff(padded.astype(np.int8), axis=1)
+
+    # entries and exits come out row-major, so the k-th entry of a row pairs with its k-th exit
+    entry_rows, entry_bars = np.nonzero(edges == 1)
+    _, exit_bars = np.nonzero(edges == -1)
+
+    start = equity[entry_rows, np.maximum(entry_bars - 1, 0)]
+    end = equity[entry_rows, np.minimum(exit_bars, n - 1)]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return entry_rows, end / start - 1
+
+
+def risk_metrics(equity, position=None, periods_per_year=PERIODS_PER_YEAR, risk_free=0.0):
+    """
+    This function computes the risk metrics of one equity curve or a whole (params, bars) matrix from a sweep (thresh_trade_batch) in one vectorized pass - ranking thousands of buy/sell thresholds costs a few array operations, not a simulation loop per configuration.
+
+    ARGS:
+        equity: <numpy.array> one equity curve (bars,) or one per parameter set (params, bars)
+        position: <numpy.array> True on the bars a position is held, same shape as equity - needed for exposure and the trade metrics, which are NaN without it
+        periods_per_year: <int> bars in a year, used to annualize - defaults to H1 candles
+        risk_free: <float> annual risk free rate
+
+    RETURNS:
+        <pandas.DataFrame> one row per equity curve:
+            total_return - last equity / first equity - 1
+            sharpe - annualized mean / std of the bar returns over the risk free rate
+            sortino - like sharpe with the downside deviation only
+            max_drawdown - the deepest drop from a peak (negative)
+            max_drawdown_duration - the longest run of bars under a previous peak
+            exposure - fraction of bars with a position open
+            trades - number of trades
+            win_rate - fraction of trades with a positive return
+            avg_trade_return - mean return of a trade
+    """
+    equity = np.atleast_2d(np.asarray(equity, dtype=np.float64))
+    p = equity.shape[0]
+
+    returns = bar_returns(equity)
+    excess = returns - risk_free / periods_per_year
+
+    # the nan-aware reductions are much slower - only needed if an equity curve hit 0
+    nan = np.isnan(excess).any()
+    mean_fn, std_fn = (np.nanmean, np.nanstd) if nan else (np.mean, np.std)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = mean_fn(excess, axis=1) if excess.shape[1] else np.full(p, np.nan)
+        std = std_fn(excess, axis=1, ddof=1) if excess.shape[1] > 1 else np.full(p, np.nan)
+        downside = np.sqrt(mean_fn(np.minimum(excess, 0) ** 2, axis=1)) if excess.shape[1] else np.full(p, np.nan)
+
+        sharpe = np.where(std > 0, mean / std * np.sqrt(periods_per_year), np.nan)
+        sortino = np.where(downside > 0, mean / downside * np.sqrt(periods_per_year), np.nan)
+        total_return = equity[:, -1] / equity[:, 0] - 1
+
+    drawdown, duration = drawdowns(equity)
+
+    metrics = {
+        'total_return': total_return,
+        'sharpe': sharpe,
+        'sortino': sortino,
+        'max_drawdown': drawdown.min(axis=1),
+        'max_drawdown_duration': duration,
+        'exposure': np.full(p, np.nan),
+        'trades': np.full(p, np.nan),
+        'win_rate': np.full(p, np.nan),
+        'avg_trade_return': np.full(p, np.nan),
+    }
+
+    if position is not None:
+        position = np.atleast_2d(np.asarray(position, dtype=bool))
+        rows, trade_return = trade_returns(equity, position)
+
+        # per row sums of the trades with bincount
+        trades = np.bincount(rows, minlength=p)
+        wins = np.bincount(rows, weights=trade_return > 0, minlength=p)
+        total = np.bincount(rows, weights=trade_return, minlength=p)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics['exposure'] = position.mean(axis=1)
+            metrics['trades'] = trades
+            metrics['win_rate'] = np.where(trades > 0, wins / trades, np.nan)
+            metrics['avg_trade_return'] = np.where(trades > 0, total / trades, np.nan)
+
+    return pd.DataFrame(metrics)
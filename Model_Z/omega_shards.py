@@ -0,0 +1,370 @@
+# Packed image shards for candlestick datasets
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import numpy as np
+
+# label codes stored in the shards
+LABELS = ['Buy', 'Sell', 'Hold']
+
+# default size of the images of one shard
+SHARD_BYTES = 256 * 1024 * 1024
+
+
+def shard_rows(shape, shard_bytes=SHARD_BYTES):
+    """
+    Returns how many images of shape (H, W, C) uint8 fit in shard_bytes - at least one.
+    """
+    return max(1, shard_bytes // int(np.prod(shape)))
+
+
+def shrink_npy(file, rows):
+    """
+    Cuts a .npy file down to its first rows in place - the header is rewritten with the new shape (it never gets longer, so the data does not move) and the file is truncated. Nothing is read into memory.
+    """
+    with open(file, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+
+        # magic string, version and the header length field come before the header itself
+        start = 8 + (2 if version == (1, 0) else 4)
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': fortran_order, 'shape': (rows,) + tuple(shape[1:])})
+        header = header.ljust(offset - start - 1) + '\n'
+
+        f.seek(start)
+        f.write(header.encode('latin1'))
+        f.truncate(offset + rows * int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+
+
+class ShardWriter:
+    """
+    Appends rendered windows into fixed-size shards instead of writing one PNG per window. Every shard is a directory holding:
+        images.npy - uint8 (N, H, W, C)
+        labels.npy - uint8 (N,) - index into LABELS
+        index.npy - int64 (N,) - the global row of every window start
+        keys.npy - uint8 (N, 20) - the window_key of every window, only if keys is True
+        meta.json - rows, shape and label names
+
+    The images are written straight into a memory-mapped .npy, so nothing is encoded and a shard never sits in memory. Each shard is written to a .tmp directory and renamed into place when it is full (or the writer is closed), so a reader never sees half a shard.
+
+    ARGS:
+        path: <string> - the dataset directory
+        prefix: <string> - shard names are {prefix}_{number}, give every worker its own prefix
+        shard_size: <int> - how many windows a shard holds, None fits SHARD_BYTES of images
+        shape: <tuple> - (H, W, C) of every image
+        keys: <boolean> - if True, every window is written with its window_key (see RenderCache)
+    """
+    def __init__(self, path, prefix='shard', shard_size=None, shape=(480, 640, 3), keys=False):
+        self.path = path
+        self.prefix = prefix
+        self.shape = tuple(shape)
+        self.shard_size = shard_size or shard_rows(self.shape)
+        self.keys = keys
+        self.shards = 0
+        self.rows = 0
+        self.tmp_path = None
+
+        os.makedirs(path, exist_ok=True)
+
+    def open_shard(self):
+        """
+        Starts a new shard - preallocates its arrays.
+        """
+        self.tmp_path = f'{self.path}/{self.prefix}_{self.shards:05d}.tmp'
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+        self.images = np.lib.format.open_memmap(f'{self.tmp_path}/images.npy', mode='w+', dtype=np.uint8, shape=(self.shard_size,) + self.shape)
+        self.labels = np.empty(self.shard_size, dtype=np.uint8)
+        self.index = np.empty(self.shard_size, dtype=np.int64)
+        self.key = np.zeros((self.shard_size, 20), dtype=np.uint8)
+        self.rows = 0
+
+    def write(self, image, label, index, key=None):
+        """
+        Appends one window.
+
+        ARGS:
+            image: <numpy array> - (H, W, C) uint8
+            label: <string or int> - 'Buy', 'Sell', 'Hold' or its code in LABELS
+            index: <int> - the global row of the window start
+            key: <bytes> - the window_key of the window
+        """
+        if self.tmp_path is None:
+            self.open_shard()
+
+        self.images[self.rows] = image
+        self.labels[self.rows] = LABELS.index(label) if isinstance(label, str) else label
+        self.index[self.rows] = index
+        if key is not None:
+            self.key[self.rows] = np.frombuffer(key, dtype=np.uint8)
+        self.rows += 1
+
+        if self.rows == self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Finishes the current shard and moves it into place. A partial shard is cut down to its rows in place (shrink_npy), never read back.
+        """
+        if self.tmp_path is None:
+            return
+
+        self.images.flush()
+        del self.images
+
+        # the last shard of a worker
+        if self.rows < self.shard_size:
+            shrink_npy(f'{self.tmp_path}/images.npy', self.rows)
+
+        np.save(f'{self.tmp_path}/labels.npy', self.labels[:self.rows])
+        np.save(f'{self.tmp_path}/index.npy', self.index[:self.rows])
+        if self.keys:
+            np.save(f'{self.tmp_path}/keys.npy', self.key[:self.rows])
+
+        with open(f'{self.tmp_path}/meta.json', 'w') as f:
+            json.dump({'rows': self.rows, 'shape': list(self.shape), 'labels': LABELS}, f)
+
+        shard_path = self.tmp_path[:-len('.tmp')]
+        if os.path.exists(shard_path):
+            shutil.rmtree(shard_path)
+        os.replace(self.tmp_path, shard_path)
+
+        self.shards += 1
+        self.tmp_path = None
+
+    def close(self):
+        """
+        Flushes the last shard.
+        """
+        if self.rows:
+            self.flush()
+        elif self.tmp_path is not None:
+            self.abort()
+
+    def abort(self):
+        """
+        Drops the shard being written.
+        """
+        if self.tmp_path is not None:
+            self.images = None
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+            self.tmp_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def list_shards(path):
+    """
+    Returns the finished shard directories of a dataset, in order.
+    """
+    return [f'{path}/{name}' for name in sorted(os.listdir(path)) if os.path.exists(f'{path}/{name}/meta.json')]
+
+
+def open_shard(shard_path):
+    """
+    Memory-maps one shard. Nothing is read until it is used.
+
+    RETURNS:
+        images, labels, index - read-only numpy arrays
+    """
+    images = np.load(f'{shard_path}/images.npy', mmap_mode='r')
+    labels = np.load(f'{shard_path}/labels.npy', mmap_mode='r')
+    index = np.load(f'{shard_path}/index.npy', mmap_mode='r')
+
+    return images, labels, index
+
+
+def open_shards(path):
+    """
+    Memory-maps every shard of a dataset. The labels and source indices are small and are concatenated, the images stay one memory-mapped array per shard.
+
+    RETURNS:
+        images, labels, index - images is a list of (N, H, W, C) arrays, labels and index cover every shard in the same order
+    """
+    shards = [open_shard(s) for s in list_shards(path)]
+    if not shards:
+        return [], np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.int64)
+
+    images = [s[0] for s in shards]
+    labels = np.concatenate([s[1] for s in shards])
+    index = np.concatenate([s[2] for s in shards])
+
+    return images, labels, index
+
+
+def iter_shards(path, batch_size=64):
+    """
+    Streams a dataset in batches straight from the memory-mapped shards - every batch is a view, no copy and no decoding. Batches never span two shards, so the last batch of a shard can be smaller.
+
+    ARGS:
+        path: <string> - the dataset directory
+        batch_size: <int> - windows per batch
+
+    YIELDS:
+        images, labels, index
+    """
+    for shard_path in list_shards(path):
+        images, labels, index = open_shard(shard_path)
+
+        for a in range(0, len(labels), batch_size):
+            yield images[a:a + batch_size], labels[a:a + batch_size], index[a:a + batch_size]
+
+
+def window_key(quotes, candle_size=0.022, style='matplotlib'):
+    """
+    Returns the content address of a rendered window: the sha1 digest (20 bytes) of its OHLC values, the spacing of its dates, its size, the candle size and the render style. Two windows with the same key render to the same pixels, whatever their labels.
+
+    ARGS:
+        quotes: <numpy array> - (window_size, 5) date, open, high, low, close
+        candle_size: <float> - the size of each candle
+        style: <string> - the renderer and anything else that changes the pixels
+    """
+    quotes = np.asarray(quotes, dtype=np.float64)
+
+    # dates only matter relative to the first candle
+    values = np.column_stack([quotes[:, 0] - quotes[0, 0], quotes[:, 1:5]])
+
+    sha = hashlib.sha1(np.ascontiguousarray(values).tobytes())
+    sha.update(f'{len(quotes)}:{candle_size!r}:{style}'.encode())
+
+    return sha.digest()
+
+
+class RenderCache:
+    """
+    A content-addressed store of rendered windows: window_key -> image. The pixels live in keyed shards (see ShardWriter) in path, so a window rendered once - for any label configuration - is never rendered again. Labels are not part of the cache, a dataset only keeps its labels and the keys of its windows (see open_cached).
+
+    New images go into new shards with a random prefix, so any number of workers (or runs) can add to the same cache without clashing. Images added by a worker are visible to others once their shard is flushed.
+
+    ARGS:
+        path: <string> - the cache directory
+        shard_size: <int> - images per cache shard, None fits SHARD_BYTES of images
+        shape: <tuple> - (H, W, C) of every image
+    """
+    def __init__(self, path, shard_size=None, shape=(480, 640, 3)):
+        self.path = path
+        self.shard_size = shard_size
+        self.shape = tuple(shape)
+        self.entries = {}
+        self.images = {}
+        self.writer = None
+
+        os.makedirs(path, exist_ok=True)
+
+        # key -> (shard, row) of every flushed image
+        for shard_path in list_shards(path):
+            if os.path.exists(f'{shard_path}/keys.npy'):
+                for row, key in enumerate(np.load(f'{shard_path}/keys.npy')):
+                    self.entries[key.tobytes()] = (shard_path, row)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """
+        Returns the cached image of a key as a read-only memory-mapped view, or None on a miss.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        shard_path, row = entry
+        if shard_path not in self.images:
+            self.images[shard_path] = np.load(f'{shard_path}/images.npy', mmap_mode='r')
+
+        return self.images[shard_path][row]
+
+    def put(self, key, image, index=-1):
+        """
+        Adds a rendered image to the cache.
+
+        ARGS:
+            key: <bytes> - window_key of the window
+            image: <numpy array> - (H, W, C) uint8
+            index: <int> - the global row the window was rendered from, kept for reference
+        """
+        if self.writer is None:
+            self.writer = ShardWriter(self.path, prefix=f'cache_{uuid.uuid4().hex[:12]}', shard_size=self.shard_size, shape=self.shape, keys=True)
+
+        # labels of cache shards are not used
+        self.writer.write(image, 0, index, key)
+
+    def close(self):
+        """
+        Flushes the images added so far.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def save_keys(path, name, labels, index, keys):
+    """
+    Writes the label metadata of a dataset whose pixels live in a RenderCache: {path}/{name}.npz with labels, index and keys.
+
+    ARGS:
+        path: <string> - the dataset directory
+        name: <string> - file name without .npz
+        labels: <numpy array> - label codes into LABELS
+        index: <numpy array> - the global row of every window start
+        keys: <list> - the window_key (bytes) of every window
+    """
+    os.makedirs(path, exist_ok=True)
+
+    tmp_file = f'{path}/{name}.tmp.npz'
+    np.savez(tmp_file, labels=np.asarray(labels, dtype=np.uint8), index=np.asarray(index, dtype=np.int64), keys=np.frombuffer(b''.join(keys), dtype=np.uint8).reshape(-1, 20))
+    os.replace(tmp_file, f'{path}/{name}.npz')
+
+
+class CachedImages:
+    """
+    The images of a cached dataset as a read-only sequence - images[i] is looked up in the RenderCache by key, no copy.
+    """
+    def __init__(self, cache, keys):
+        self.cache = cache
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, i):
+        return self.cache.get(self.keys[i].tobytes())
+
+
+def open_cached(path, cache_path):
+    """
+    Opens a dataset written with output='cache' - its labels, source indices and keys from path, its pixels from the RenderCache in cache_path.
+
+    RETURNS:
+        images, labels, index - images is a CachedImages sequence
+    """
+    files = [f'{path}/{name}' for name in sorted(os.listdir(path)) if name.endswith('.npz') and not name.endswith('.tmp.npz')]
+    parts = [np.load(f) for f in files]
+
+    labels = np.concatenate([p['labels'] for p in parts]) if parts else np.empty(0, dtype=np.uint8)
+    index = np.concatenate([p['index'] for p in parts]) if parts else np.empty(0, dtype=np.int64)
+    keys = np.concatenate([p['keys'] for p in parts]) if parts else np.empty((0, 20), dtype=np.uint8)
+
+    return CachedImages(RenderCache(cache_path), keys), labels, index
@@ -2,9 +2,337 @@ import pandas as pd
 import math
 import numpy as np
 import os
+import itertools
+import collections
+import contextlib
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+from omega_metrics import risk_metrics, PERIODS_PER_YEAR
+
+# trade ledger - one record per fill
+BUY = 1
+SELL = -1
+LIQUIDATION = -2 # forced sell of a margin closeout
+SIDES = {BUY: 'Buy', SELL: 'Sell', LIQUIDATION: 'Liquidation'}
+
+LEDGER_DTYPE = np.dtype([
+    ('bar', np.int64),       # bar the fill happened on
+    ('side', np.int8),       # BUY, SELL or LIQUIDATION
+    ('price', np.float64),   # fill price
+    ('units', np.int64),     # shares bought or sold
+    ('cost', np.float64),    # transaction cost of the fill
+    ('capital', np.float64), # cash after the fill
+    ('sell_thresh', np.float64), # sell threshold set by a buy of the 'stop' exit rule, NaN otherwise
+])
+
+# fills of every parameter set of margin_trade_batch - units are float64, leveraged sizes can outgrow int64
+MARGIN_LEDGER_DTYPE = np.dtype([('param', np.int64)] + [(name, np.float64 if name == 'units' else dtype) for name, dtype in LEDGER_DTYPE.descr])
+
+
+# backtest engine
+def thresh_trade_engine(open_, signal, change_window, buy_threshold, sell_threshold, start_cap, close_=None, entry='open', exit_rule='signal', cost_fn=None):
+    """
+    This is the core buy/sell state machine shared by every simulate_thresh_test_trade* function. It runs in a single pass over plain arrays instead of slicing a DataFrame window on every bar, which is where all the time was going.
+
+    Bar i looks at the change value at j = i + change_window (clipped to the last bar), exactly like window.iloc[-1] did on sequence.iloc[i:i + change_window + 1].
+
+    ARGS:
+        open_: <numpy.array> opening prices
+        signal: <numpy.array> percentage change values of the change window, example: sequence['24'].values
+        change_window: <int or string> the change window size, example: '24'
+        buy_threshold: <float> how much % of a change must there be for this to be a buy
+        sell_threshold: <float> how much % of a drop must there be for this to be a sell (only used by the 'signal' and 'stop' exit rules)
+        start_cap: <int or float> our starting capital (already leveraged if margin trading)
+        close_: <numpy.array> closing prices - only needed when entry='mid'
+        entry: <string> 'open' buys at the open of bar i, 'mid' buys at (open + close) / 2 of bar i
+        exit_rule: <string>
+            'signal' = sell at the open before the end of the window once the change drops below -sell_threshold (simulate_thresh_test_trade)
+            'stop' = sell once the open drops below the sell threshold fixed at buying time (simulate_thresh_test_trade_best)
+            'window' = sell at the open at the end of the window and skip ahead (simulate_thresh_test_trade_simple)
+        cost_fn: <function or CostModel> transaction cost per trade given the number of shares, example: omega_oanda_core_cost. A CostModel is given the bar of the trade too. None means no cost
+
+    RETURNS:
+        bc, h, total_transaction_costs, tni, tnf, ledger, equity
+
+        tni and tnf are the last buying and selling prices (None if no trade was made)
+        ledger is every fill as a LEDGER_DTYPE structured array, written into a preallocated array as the fills happen
+        equity is the capital marked to the open of every bar after trading, shape (bars,) - like thresh_trade_batch
+    """
+    if entry not in ('open', 'mid'):
+        raise ValueError(f"entry must be 'open' or 'mid', got {entry!r}")
+    if exit_rule not in ('signal', 'stop', 'window'):
+        raise ValueError(f"exit_rule must be 'signal', 'stop' or 'window', got {exit_rule!r}")
+    if entry == 'mid' and close_ is None:
+        raise ValueError("close_ is needed for entry='mid'")
+
+    # indexing python lists is much cheaper than indexing numpy/pandas scalars
+    open_ = np.asarray(open_, dtype=np.float64).tolist()
+    signal = np.asarray(signal, dtype=np.float64).tolist()
+    if close_ is not None:
+        close_ = np.asarray(close_, dtype=np.float64).tolist()
+
+    n = len(open_)
+    if isinstance(cost_fn, CostModel):
+        cost_fn.check_bars(n)
+    window_size = int(change_window)
+    x_s = -sell_threshold
+    sell_thresh = 0
+
+    bc = start_cap
+    h = 0 # how many assets we own
+
+    tni = None
+    tnf = None
+    core_cost = 0
+
+    # tracking metrics
+    total_transaction_costs = 0
+
+    # at most two fills per bar
+    ledger = np.empty(2 * n, dtype=LEDGER_DTYPE)
+    fills = 0
+
+    # SIMPLE - buy and sell at the end of the window, then jump ahead of it
+    if exit_rule == 'window':
+        start_idx = 0
+
+        # bars before marked have their equity
+        equity = np.empty(n, dtype=np.float64)
+        marked = 0
+        open_arr = np.asarray(open_)
+
+        for i in range(n):
+
+            # an empty window would never move forward again
+            if start_idx >= n:
+                break
+
+            end = min(start_idx + window_size, n - 1)
+            equity[marked:start_idx] = bc
+
+            # buying trade if buy threshold met
+            if signal[end] >= buy_threshold and bc > 0 and h == 0:
+                pni = open_[end]
+                tni = (open_[start_idx] + close_[start_idx]) / 2 if entry == 'mid' else open_[start_idx]
+
+                # charging the cost of the trade before buying
+                if cost_fn is not None:
+                    core_cost = trade_cost(cost_fn, math.floor(bc / tni), start_idx)
+                    total_transaction_costs += core_cost
+                    bc = bc - core_cost
+
+                h = math.floor(bc / tni)
+                bc = bc - (h * tni)
+
+                ledger[fills] = (start_idx, BUY, tni, h, core_cost, bc, np.nan)
+                fills += 1
+
+                # holding until the end of the window - the end bar (also the entry bar if the window was clipped to it) is marked after selling
+                equity[start_idx:end] = bc + (h * open_arr[start_idx:end])
+                marked = end
+
+                # Selling - end of window
+                bc = bc + (h * pni)
+
+                if cost_fn is not None:
+                    core_cost = trade_cost(cost_fn, h, end)
+                    total_transaction_costs += core_cost
+                    bc = bc - core_cost
+
+                ledger[fills] = (end, SELL, pni, h, core_cost, bc, np.nan)
+                fills += 1
+
+                h = 0
+                start_idx += window_size
+
+            # no threshold met - we HOLD
+            else:
+                equity[start_idx] = bc
+                marked = start_idx + 1
+                start_idx += 1
+
+        equity[marked:] = bc
+
+        return bc, h, total_transaction_costs, tni, tnf, ledger[:fills].copy(), equity
+
+    # Trading
+    equity = [0.0] * n
+
+    for i in range(n):
+        end = min(i + window_size, n - 1)
+
+        # buying trade if buy threshold met
+        if signal[end] >= buy_threshold and bc > 0 and h == 0:
+            tni = (open_[i] + close_[i]) / 2 if entry == 'mid' else open_[i]
+
+            # charging the cost of the trade before buying
+            if cost_fn is not None:
+                core_cost = trade_cost(cost_fn, math.floor(bc / tni), i)
+                total_transaction_costs += core_cost
+                bc = bc - core_cost
+
+            h = math.floor(bc / tni)
+
+            # initializing our sell threshold
+            if exit_rule == 'stop':
+                pni = open_[end]
+                sell_thresh = pni + (pni * x_s)
+
+            # updating our capital to what is left over
+            bc = bc - (h * tni)
+
+            ledger[fills] = (i, BUY, tni, h, core_cost, bc, sell_thresh if exit_rule == 'stop' else np.nan)
+            fills += 1
+
+        # selling assets if sell threshold is met
+        elif (signal[end] <= x_s if exit_rule == 'signal' else open_[end] <= sell_thresh) and h > 0:
+
+            # the window only holds one bar - there is no bar before the end to sell at
+            if end == i:
+                raise IndexError('single positional indexer is out-of-bounds')
+
+            tnf = open_[end - 1] # selling at open
+            bc = bc + (h * tnf)
+
+            if cost_fn is not None:
+                core_cost = trade_cost(cost_fn, h, end - 1)
+                total_transaction_costs += core_cost
+                bc = bc - core_cost
+
+            ledger[fills] = (end - 1, SELL, tnf, h, core_cost, bc, np.nan)
+            fills += 1
+
+            # updating shares own - sold all
+            h = 0
+
+        equity[i] = bc + (h * open_[i])
+
+    return bc, h, total_transaction_costs, tni, tnf, ledger[:fills].copy(), np.array(equity)
+
+
+def log_trades(sequence, ledger, show_cost=True):
+    """
+    Prints the trade ledger of thresh_trade_engine in the same format the simulations always printed them in.
+
+    ARGS:
+        sequence: <pandas.DataFrame> the sequence the trades were simulated on
+        ledger: <numpy.array> LEDGER_DTYPE fills returned by thresh_trade_engine
+        show_cost: <boolean> if True, the transaction cost of every trade is printed
+    """
+    for bar, side, price, h, core_cost, capital, sell_thresh in ledger.tolist():
+
+        if side == BUY:
+            print('----------------------------------------')
+            print('Buying')
+            print(sequence.iloc[bar])
+            print(f'capital: {capital + (h * price)}')
+            print(f'bought at: {price}')
+            if show_cost:
+                print(f'transaction cost: {core_cost}')
+            if not math.isnan(sell_thresh):
+                print(f'Sell threshold: {sell_thresh}')
+            print(f'bought {h} shares\n\n')
+
+        else:
+            print('Selling' if side == SELL else 'Margin closeout - liquidating')
+            print(sequence.iloc[bar])
+            print(f'capital: {capital}')
+            print(f'sold at: {price}')
+            if show_cost:
+                print(f'transaction cost: {core_cost}')
+            print(f'sold {h} shares\n')
+
+
+def thresh_trade_batch(open_, signal, change_window, buy_thresholds, sell_thresholds, start_cap, cost_fn=None, return_position=False):
+    """
+    This is the batched version of thresh_trade_engine with the 'open' entry and 'signal' exit (simulate_thresh_test_trade). Instead of re-scanning the price series once per parameter set, the position state of every (buy_threshold, sell_threshold) pair is kept as arrays and all of them are advanced together bar by bar.
+
+    The only difference with thresh_trade_engine is a sell triggered on the very last bar: there is no bar before the end of the window to sell at, so the position is kept open instead of raising.
+
+    ARGS:
+        open_: <numpy.array> opening prices, shape (bars,)
+        signal: <numpy.array> percentage change values of the change window, shape (bars,)
+        change_window: <int or string> the change window size, example: '24'
+        buy_thresholds: <numpy.array> one buy threshold per parameter set, shape (params,)
+        sell_thresholds: <numpy.array> one sell threshold per parameter set, shape (params,)
+        start_cap: <int or float> our starting capital (already leveraged if margin trading)
+        cost_fn: <function or CostModel> transaction cost given an array of shares, example: omega_oanda_core_cost. A CostModel is given the bar of the trades too. None means no cost
+        return_position: <boolean> if True, whether a position is held after trading on every bar is returned too (for omega_metrics.risk_metrics)
+
+    RETURNS:
+        bc, h, total_transaction_costs, tnf, equity (, position)
+
+        bc, h, total_transaction_costs and tnf (last selling price, NaN if never sold) have shape (params,)
+        equity is the capital marked to the open of every bar after trading, shape (params, bars)
+        position is True on the bars a position is held after trading, shape (params, bars)
+    """
+    open_ = np.asarray(open_, dtype=np.float64)
+    signal = np.asarray(signal, dtype=np.float64)
+    buy_thresholds = np.asarray(buy_thresholds, dtype=np.float64)
+    x_s = -np.asarray(sell_thresholds, dtype=np.float64)
+
+    if buy_thresholds.shape != x_s.shape:
+        raise ValueError('buy_thresholds and sell_thresholds must have the same shape')
+
+    n = len(open_)
+    if isinstance(cost_fn, CostModel):
+        cost_fn.check_bars(n)
+    p = len(buy_thresholds)
+    window_size = int(change_window)
+
+    # position state for every parameter set
+    bc = np.full(p, start_cap, dtype=np.float64)
+    h = np.zeros(p, dtype=np.float64)
+    tnf = np.full(p, np.nan)
+    total_transaction_costs = np.zeros(p, dtype=np.float64)
+    equity = np.empty((p, n), dtype=np.float64)
+    position = np.empty((p, n), dtype=bool) if return_position else None
+
+    for i in range(n):
+        end = min(i + window_size, n - 1)
+        change = signal[end]
+
+        # buying trade if buy threshold met
+        buy = (change >= buy_thresholds) & (bc > 0) & (h == 0)
+
+        # selling assets if sell threshold is met
+        sell = ~buy & (change <= x_s) & (h > 0) & (end > i)
+
+        if buy.any():
+            tni = open_[i]
+
+            if cost_fn is not None:
+                core_cost = trade_cost(cost_fn, np.floor(bc[buy] / tni), i)
+                total_transaction_costs[buy] += core_cost
+                bc[buy] -= core_cost
+
+            h[buy] = np.floor(bc[buy] / tni)
+            bc[buy] -= h[buy] * tni
+
+        if sell.any():
+            tnf[sell] = open_[end - 1]
+            bc[sell] += h[sell] * open_[end - 1]
+
+            if cost_fn is not None:
+                core_cost = trade_cost(cost_fn, h[sell], end - 1)
+                total_transaction_costs[sell] += core_cost
+                bc[sell] -= core_cost
+
+            h[sell] = 0
+
+        equity[:, i] = bc + (h * open_[i])
+        if return_position:
+            position[:, i] = h > 0
+
+    if return_position:
+        return bc, h, total_transaction_costs, tnf, equity, position
+
+    return bc, h, total_transaction_costs, tnf, equity
+
 
 # trading function
-def simulate_thresh_test_trade_basic(sequence, buy_threshold, sell_threshold, start_cap, print_trades=True, return_attr=True):
+def simulate_thresh_test_trade_basic(sequence, buy_threshold, sell_threshold, start_cap, print_trades=True, return_attr=True, return_ledger=False):
     """
     This function will simulate a trade when given a sequence dataframe with a specific column holding percentage change values. SIMPLE does not include spread cost per currency pair OR leverage functionality
     
@@ -25,9 +353,11 @@ def simulate_thresh_test_trade_basic(sequence, buy_threshold, sell_threshold, st
         window_size: <int> represents how large of a window this can also be set from int(sequence['change_window'])
         
         print_trades: <boolean> if True, this will print every trade made 
+        
+        return_ledger: <boolean> if True, the trade ledger and the equity curve of thresh_trade_engine are returned after the other values
     
     RETURNS:
-        start_cap, bc, roi, buy_threshold, sell_threshold, change_window
+        start_cap, bc, roi, buy_threshold, sell_threshold, change_window (+ ledger, equity)
     
     ALGORITHM:
     if pn0 > x && bc > 0 && h == 0:
@@ -48,75 +378,19 @@ def simulate_thresh_test_trade_basic(sequence, buy_threshold, sell_threshold, st
         pass
     """
     # setting our parameters
-    x_p = buy_threshold
-    x_s = -sell_threshold
-    
     bc = start_cap
     starting_cap = start_cap
     
-    h = 0 # how many assets we own
-    
     change_window = sequence.columns[2] # column with change window size
     
-    start_idx = 0
-    end_idx = int(change_window) + 1
+    # Trading - single pass over the raw arrays
+    bc, h, _, tni, tnf, ledger, equity = thresh_trade_engine(
+        sequence['open'].values, sequence[change_window].values, change_window,
+        buy_threshold, sell_threshold, bc
+    )
     
-    # Trading
-    for i in range(len(sequence)):
-        
-        # grabbing window
-        window = sequence.iloc[start_idx:end_idx]
-        
-        # buying trade if buy threshold met
-        if window.iloc[-1][change_window] >= buy_threshold and bc > 0 and h == 0:
-            
-            # grabbing end and beginning of window
-            pn0 = window.iloc[-1]
-            tn0 = window.iloc[0]
-            tni = tn0['open'] # buying the opening price
-            
-            # buying h shares
-            h = math.floor(bc / tni)
-            
-            if print_trades:
-                print('----------------------------------------')
-                print('Buying')
-                print(tn0)
-                print(f'capital: {bc}')
-                print(f'bought at: {tni}')
-                print(f'bought {h} shares\n\n')
-            
-            # updating our capital to what is left over
-            bc = bc - (h * tni)
-            
-            
-        # selling assets if sell threshold is met
-        elif window.iloc[-1][change_window] <= x_s and h > 0:
-            
-            # grabbing final buy - best one to grab
-            tnf0 = window.iloc[-2]
-            tnf = tnf0['open'] # selling at open
-            
-            # selling off shares
-            bc = bc + (h * tnf)
-            
-            if print_trades:
-                print('Selling')
-                print(tnf0)
-                print(f'capital: {bc}')
-                print(f'sold at: {tnf}')
-                print(f'sold {h} shares\n')
-                
-            # updating shares own - sold all
-            h = 0
-            
-        # no threshold met - we HOLD
-        else:
-            pass
-        
-        # moving window
-        start_idx += 1
-        end_idx += 1
+    if print_trades:
+        log_trades(sequence, ledger, show_cost=False)
     
     # update our buying capital if we haven't sold
     if bc > 0 and bc < 100:
@@ -133,10 +407,12 @@ def simulate_thresh_test_trade_basic(sequence, buy_threshold, sell_threshold, st
     
     if return_attr:
         # returning metrics & others
+        if return_ledger:
+            return start_cap, bc, roi, buy_threshold, sell_threshold, change_window, ledger, equity
         return start_cap, bc, roi, buy_threshold, sell_threshold, change_window
 
 
-def simulate_thresh_test_trade(sequence, buy_threshold, sell_threshold, start_cap, print_trades=True, return_attr=True, margin_trading=False):
+def simulate_thresh_test_trade(sequence, buy_threshold, sell_threshold, start_cap, print_trades=True, return_attr=True, margin_trading=False, return_ledger=False):
     """
     This function will simulate a trade when given a sequence dataframe with a specific column holding percentage change values. 
     
@@ -157,9 +433,11 @@ def simulate_thresh_test_trade(sequence, buy_threshold, sell_threshold, start_ca
         window_size: <int> represents how large of a window this can also be set from int(sequence['change_window'])
         
         print_trades: <boolean> if True, this will print every trade made 
+        
+        return_ledger: <boolean> if True, the trade ledger and the equity curve of thresh_trade_engine are returned after the other values
     
     RETURNS:
-        start_cap, bc, roi, buy_threshold, sell_threshold, change_window
+        start_cap, bc, roi, buy_threshold, sell_threshold, change_window (+ ledger, equity)
     
     ALGORITHM:
     if pn0 > x && bc > 0 && h == 0:
@@ -180,102 +458,25 @@ def simulate_thresh_test_trade(sequence, buy_threshold, sell_threshold, start_ca
         pass
     """
     # setting our parameters
-    x_p = buy_threshold
-    x_s = -sell_threshold
-    
     bc = start_cap
     starting_cap = start_cap
     
-    h = 0 # how many assets we own
-    
     change_window = sequence.columns[2] # column with change window size
     
-    start_idx = 0
-    end_idx = int(change_window) + 1
-    
-    # tracking metrics
-    total_transaction_costs = 0
-    
     # checking for margin trading
     if margin_trading:
         bc = margin_trade(bc)
         beginning_leverage = bc
     
-    # Trading
-    for i in range(len(sequence)):
-        
-        # grabbing window
-        window = sequence.iloc[start_idx:end_idx]
-        
-        # buying trade if buy threshold met
-        if window.iloc[-1][change_window] >= buy_threshold and bc > 0 and h == 0:
-            
-            # grabbing end and beginning of window
-            pn0 = window.iloc[-1]
-            tn0 = window.iloc[0]
-            tni = tn0['open'] # buying the opening price
-            
-            # calculating how many shares we can buy with our current capital - without trasaction cost included
-            h_pre = math.floor(bc / tni)
-            
-            # calculating our cost of the trade - using core
-            core_cost = omega_oanda_core_cost(h_pre)
-            total_transaction_costs += core_cost
-            
-            # updating our capital - charging the core cost of the trade
-            bc = bc - core_cost
-            
-            # buying h shares with core cost included
-            h = math.floor(bc / tni)
-            
-            if print_trades:
-                print('----------------------------------------')
-                print('Buying')
-                print(tn0)
-                print(f'capital: {bc}')
-                print(f'bought at: {tni}')
-                print(f'transaction cost: {core_cost}')
-                print(f'bought {h} shares\n\n')
-            
-            # updating our capital to what is left over
-            bc = bc - (h * tni)
-            
-            
-        # selling assets if sell threshold is met
-        elif window.iloc[-1][change_window] <= x_s and h > 0:
-            
-            # grabbing final buy - best one to grab
-            tnf0 = window.iloc[-2]
-            tnf = tnf0['open'] # selling at open
-            
-            # selling off shares
-            bc = bc + (h * tnf)
-            
-            # calculating our core cost
-            core_cost = omega_oanda_core_cost(h)
-            total_transaction_costs += core_cost
-            
-            # upating our capital with core cost
-            bc = bc - core_cost
-            
-            if print_trades:
-                print('Selling')
-                print(tnf0)
-                print(f'capital: {bc}')
-                print(f'sold at: {tnf}')
-                print(f'transaction cost: {core_cost}')
-                print(f'sold {h} shares\n')
-                
-            # updating shares own - sold all
-            h = 0
-            
-        # no threshold met - we HOLD
-        else:
-            pass
-        
-        # moving window
-        start_idx += 1
-        end_idx += 1
+    # Trading - single pass over the raw arrays
+    bc, h, total_transaction_costs, tni, tnf, ledger, equity = thresh_trade_engine(
+        sequence['open'].values, sequence[change_window].values, change_window,
+        buy_threshold, sell_threshold, bc,
+        entry='open', exit_rule='signal', cost_fn=omega_oanda_core_cost
+    )
+    
+    if print_trades:
+        log_trades(sequence, ledger)
     
     # update our buying capital if we haven't sold
     if bc > 0 and bc < 100 and h > 0:
@@ -298,10 +499,12 @@ def simulate_thresh_test_trade(sequence, buy_threshold, sell_threshold, start_ca
     
     if return_attr:
         # returning metrics & others
+        if return_ledger:
+            return start_cap, bc, roi, buy_threshold, sell_threshold, change_window, ledger, equity
         return start_cap, bc, roi, buy_threshold, sell_threshold, change_window
 
 
-def simulate_thresh_test_trade_best(sequence, buy_threshold, sell_threshold, start_cap, print_trades=True, return_attr=True, margin_trading=False):
+def simulate_thresh_test_trade_best(sequence, buy_threshold, sell_threshold, start_cap, print_trades=True, return_attr=True, margin_trading=False, return_ledger=False):
     """
     This function will simulate a trade when given a sequence dataframe with a specific column holding percentage change values. The differnce between this and the simulate_thresh_test_trade is that we will sell upon the price dropping sell_threshold from the price we bought at, not at the 24 hour window.
     
@@ -324,9 +527,11 @@ def simulate_thresh_test_trade_best(sequence, buy_threshold, sell_threshold, sta
         window_size: <int> represents how large of a window this can also be set from int(sequence['change_window'])
         
         print_trades: <boolean> if True, this will print every trade made 
+        
+        return_ledger: <boolean> if True, the trade ledger and the equity curve of thresh_trade_engine are returned after the other values
     
     RETURNS:
-        start_cap, bc, roi, buy_threshold, sell_threshold, change_window
+        start_cap, bc, roi, buy_threshold, sell_threshold, change_window (+ ledger, equity)
     
     ALGORITHM:
     if pn0 > x && bc > 0 && h == 0:
@@ -347,113 +552,25 @@ def simulate_thresh_test_trade_best(sequence, buy_threshold, sell_threshold, sta
         pass
     """
     # setting our parameters
-    x_p = buy_threshold
-    x_s = -sell_threshold
-    sell_thresh = 0
-    
     bc = start_cap
     starting_cap = start_cap
     
-    h = 0 # how many assets we own
-    
     change_window = sequence.columns[2] # column with change window size
     
-    start_idx = 0
-    end_idx = int(change_window) + 1
-    
-    # tracking metrics
-    total_transaction_costs = 0
-    
     # checking for margin trading
     if margin_trading:
         bc = margin_trade(bc)
         beginning_leverage = bc
     
-    # Trading
-    for i in range(len(sequence)):
-        
-        # grabbing window
-        window = sequence.iloc[start_idx:end_idx]
-        
-        # buying trade if buy threshold met
-        if window.iloc[-1][change_window] >= buy_threshold and bc > 0 and h == 0:
-            
-            # grabbing end and beginning of window
-            pn0 = window.iloc[-1]
-            pni = pn0['open']
-            tn0 = window.iloc[0]
-            
-            # buying mid
-            tni = (tn0['open'] + tn0['close']) / 2 # buying the opening price
-            
-            # calculating how many shares we can buy with our current capital - without trasaction cost included
-            h_pre = math.floor(bc / tni)
-            
-            # calculating our cost of the trade - using core
-            core_cost = omega_oanda_core_cost(h_pre)
-            total_transaction_costs += core_cost
-            
-            # updating our capital - charging the core cost of the trade
-            bc = bc - core_cost
-            
-            # buying h shares with core cost included
-            h = math.floor(bc / tni)
-            
-            # initializing our sell threshold
-            sell_thresh = pni + (pni * x_s)
-            
-            if print_trades:
-                print('----------------------------------------')
-                print('Buying')
-                print(tn0)
-                print(f'capital: {bc}')
-                print(f'bought at: {tni}')
-                print(f'transaction cost: {core_cost}')
-                print(f'Sell threshold: {sell_thresh}')
-                print(f'bought {h} shares\n\n')
-            
-            # updating our capital to what is left over
-            bc = bc - (h * tni)
-            
-            
-        # selling assets if sell threshold is met
-        elif window.iloc[-1]['open'] <= sell_thresh and h > 0:
-            
-            # grabbing final buy - best one to grab
-            tnf0 = window.iloc[-2]
-            tnf = tnf0['open'] # selling at open
-            
-            # selling off shares
-            bc = bc + (h * tnf)
-            
-            # calculating our core cost
-            core_cost = omega_oanda_core_cost(h)
-            total_transaction_costs += core_cost
-            
-            # upating our capital with core cost
-            bc = bc - core_cost
-            
-            if print_trades:
-                print('Selling')
-                print(tnf0)
-                print(f'capital: {bc}')
-                print(f'sold at: {tnf}')
-                print(f'transaction cost: {core_cost}')
-                print(f'sold {h} shares\n')
-                
-            # updating shares own - sold all
-            h = 0
-            
-        # no threshold met - we HOLD
-        else:
-            pass
-        
-        # moving window
-        start_idx += 1
-        end_idx += 1
-        
-        # updating our sell threshold
-        
+    # Trading - single pass over the raw arrays
+    bc, h, total_transaction_costs, tni, tnf, ledger, equity = thresh_trade_engine(
+        sequence['open'].values, sequence[change_window].values, change_window,
+        buy_threshold, sell_threshold, bc, close_=sequence['close'].values,
+        entry='mid', exit_rule='stop', cost_fn=omega_oanda_core_cost
+    )
+    
+    if print_trades:
+        log_trades(sequence, ledger)
     
     # update our buying capital if we haven't sold
     if bc > 0 and bc < 100 and h > 0:
@@ -476,10 +593,12 @@ def simulate_thresh_test_trade_best(sequence, buy_threshold, sell_threshold, sta
     
     if return_attr:
         # returning metrics & others
+        if return_ledger:
+            return start_cap, bc, roi, buy_threshold, sell_threshold, change_window, ledger, equity
         return start_cap, bc, roi, buy_threshold, sell_threshold, change_window
 
 
-def simulate_thresh_test_trade_simple(sequence, buy_threshold, start_cap, print_trades=True, return_attr=True, margin_trading=False):
+def simulate_thresh_test_trade_simple(sequence, buy_threshold, start_cap, print_trades=True, return_attr=True, margin_trading=False, return_ledger=False):
     """
     This function will simulate a trade when given a sequence dataframe with a specific column holding percentage change values. This will follow a simple trading rule in which we will buy upon buy_threshold which will mimic our CNN and sell at the prediction window. 
     
@@ -500,9 +619,11 @@ def simulate_thresh_test_trade_simple(sequence, buy_threshold, start_cap, print_
         window_size: <int> represents how large of a window this can also be set from int(sequence['change_window'])
         
         print_trades: <boolean> if True, this will print every trade made 
+        
+        return_ledger: <boolean> if True, the trade ledger and the equity curve of thresh_trade_engine are returned after the other values
     
     RETURNS:
-        start_cap, bc, roi, buy_threshold, sell_threshold, change_window
+        start_cap, bc, roi, buy_threshold, sell_threshold, change_window (+ ledger, equity)
     
     ALGORITHM:
     if pn0 > x && bc > 0 && h == 0:
@@ -516,107 +637,25 @@ def simulate_thresh_test_trade_simple(sequence, buy_threshold, start_cap, print_
         pass
     """
     # setting our parameters
-    x_p = buy_threshold
-    
     bc = start_cap
     starting_cap = start_cap
     
-    h = 0 # how many assets we own
-    
     change_window = sequence.columns[2] # column with change window size
     
-    start_idx = 0
-    end_idx = int(change_window) + 1
-    
-    # tracking metrics
-    total_transaction_costs = 0
-    
     # checking for margin trading
     if margin_trading:
         bc = margin_trade(bc)
         beginning_leverage = bc
     
-    # Trading
-    for i in range(len(sequence)):
-        
-        try:
-        
-            # grabbing window
-            window = sequence.iloc[start_idx:end_idx]
-            pn0 = window.iloc[-1]
-
-            # buying trade if buy threshold met
-            if window.iloc[-1][change_window] >= buy_threshold and bc > 0 and h == 0:
-
-                # grabbing end and beginning of window
-                pn0 = window.iloc[-1]
-                pni = pn0['open']
-                tn0 = window.iloc[0]
-
-                # buying mid
-                tni = (tn0['open'] + tn0['close']) / 2 # buying the opening price
-
-                # calculating how many shares we can buy with our current capital - without trasaction cost included
-                h_pre = math.floor(bc / tni)
-
-                # calculating our cost of the trade - using core
-                core_cost = omega_oanda_core_cost(h_pre)
-                total_transaction_costs += core_cost
-
-                # updating our capital - charging the core cost of the trade
-                bc = bc - core_cost
-
-                # buying h shares with core cost included
-                h = math.floor(bc / tni)
-
-                if print_trades:
-                    print('----------------------------------------')
-                    print('Buying')
-                    print(tn0)
-                    print(f'capital: {bc}')
-                    print(f'bought at: {tni}')
-                    print(f'transaction cost: {core_cost}')
-                    print(f'bought {h} shares\n\n')
-
-                # updating our capital to what is left over
-                bc = bc - (h * tni)
-
-                # Selling - end of window
-                bc = bc + (h * pni)
-
-                # calculating our core cost
-                core_cost = omega_oanda_core_cost(h)
-                total_transaction_costs += core_cost
-
-                # upating our capital with core cost
-                bc = bc - core_cost
-
-                if print_trades:
-                    print('Selling')
-                    print(pn0)
-                    print(f'capital: {bc}')
-                    print(f'sold at: {pni}')
-                    print(f'transaction cost: {core_cost}')
-                    print(f'sold {h} shares\n')
-
-                # updating shares own - sold all
-                h = 0
-
-                start_idx += int(change_window)
-                end_idx += int(change_window)
-
-            # no threshold met - we HOLD
-            else:
-                # moving window
-                start_idx += 1
-                end_idx += 1
-                pass
-            
-        except Exception:
-            pass
-        
-        # updating our sell threshold
-        
+    # Trading - single pass over the raw arrays
+    bc, h, total_transaction_costs, tni, tnf, ledger, equity = thresh_trade_engine(
+        sequence['open'].values, sequence[change_window].values, change_window,
+        buy_threshold, 0, bc, close_=sequence['close'].values,
+        entry='mid', exit_rule='window', cost_fn=omega_oanda_core_cost
+    )
+    
+    if print_trades:
+        log_trades(sequence, ledger)
     
     # update our buying capital if we haven't sold
     if bc > 0 and bc < 100 and h > 0:
@@ -639,16 +678,134 @@ def simulate_thresh_test_trade_simple(sequence, buy_threshold, start_cap, print_
     
     if return_attr:
         # returning metrics & others
+        if return_ledger:
+            return start_cap, bc, roi, buy_threshold, change_window, ledger, equity
         return start_cap, bc, roi, buy_threshold, change_window
-    
+
+
+class CostModel:
+    """
+    Transaction costs of whole arrays of trades at once - the spread, a commission schedule and slippage, any of which can change from bar to bar. omega_oanda_core_cost is the default model: a fixed 0.00002 spread and 5 per 100k units.
+
+    The cost of a trade of units on bar b is:
+        units * spread[b] + (units / commission_per) * commission + units * slippage[b]
+
+    with the commission looked up in the schedule by the size of the trade if one is given. Every per-bar array is indexed by the bar of the trade, so bars must be given with units as soon as one of them is an array.
+
+    The backtests (thresh_trade_engine, thresh_trade_batch, StreamBacktest) pass the bar of every fill to a CostModel - use trade_costs to price a whole ledger after the fact.
+
+    ARGS:
+        spread: <float or numpy.array> the spread (ask - bid), or one per bar - see from_bid_ask
+        commission: <float> commission per commission_per units
+        commission_per: <int> the lot the commission is charged on
+        schedule: <list> (min_units, commission) tiers, replaces commission - example: [(0, 5), (1000000, 4), (10000000, 3)]
+        slippage: <float, numpy.array or function> price slippage per unit, one per bar, or a function (units, bars) -> slippage per unit
+    """
+    def __init__(self, spread=0.00002, commission=5, commission_per=100000, schedule=None, slippage=0.0):
+        self.spread = spread if np.ndim(spread) == 0 else np.asarray(spread, dtype=np.float64)
+        self.commission = commission
+        self.commission_per = commission_per
+        self.slippage = slippage if callable(slippage) or np.ndim(slippage) == 0 else np.asarray(slippage, dtype=np.float64)
+
+        # tiers sorted by size for searchsorted
+        self.tiers = None
+        if schedule:
+            schedule = sorted(schedule)
+            self.tiers = np.array([s[0] for s in schedule], dtype=np.float64)
+            self.rates = np.array([s[1] for s in schedule], dtype=np.float64)
+
+        # nothing per bar or per size - costs is plain arithmetic on units
+        self.flat = self.tiers is None and np.ndim(self.spread) == 0 and np.ndim(self.slippage) == 0 and not callable(self.slippage)
+
+    @classmethod
+    def from_bid_ask(cls, bid, ask, **kwargs):
+        """
+        Returns a CostModel with the spread of every bar taken from bid and ask candles (same length as the simulated series).
+        """
+        return cls(spread=np.asarray(ask, dtype=np.float64) - np.asarray(bid, dtype=np.float64), **kwargs)
+
+    def check_bars(self, bars):
+        """
+        Raises a ValueError if a per-bar spread or slippage does not cover a series of bars candles - an engine would otherwise fail on (or skip) the first trade past its end.
+        """
+        for name, values in (('spread', self.spread), ('slippage', self.slippage)):
+            if not callable(values) and np.ndim(values) and len(values) != bars:
+                raise ValueError(f'per-bar {name} has {len(values)} bars, the series has {bars}')
+
+    def per_bar(self, values, bars):
+        """
+        Returns a scalar as is, or the values of a per-bar array on bars.
+        """
+        if np.ndim(values) == 0:
+            return values
+        if bars is None:
+            raise ValueError('per-bar costs need the bar of every trade')
+
+        return values[bars]
+
+    def commission_rate(self, units):
+        """
+        Returns the commission per commission_per units of trades of units - from the schedule if there is one (the first tier applies below its minimum).
+        """
+        if self.tiers is None:
+            return self.commission
+
+        tier = np.searchsorted(self.tiers, units, side='right') - 1
+
+        return self.rates[np.maximum(tier, 0)]
+
+    def costs(self, units, bars=None):
+        """
+        Returns the cost of every trade.
+
+        ARGS:
+            units: <int or numpy.array> the number of shares of every trade
+            bars: <int or numpy.array> the bar of every trade, needed if the spread or slippage is per bar
+
+        RETURNS:
+            <float or numpy.array> same shape as units
+        """
+        if self.flat:
+            return units * self.spread + ((units / self.commission_per) * self.commission) + units * self.slippage
+
+        spread = self.per_bar(self.spread, bars)
+        slippage = self.slippage(units, bars) if callable(self.slippage) else self.per_bar(self.slippage, bars)
+
+        cost = units * spread + ((units / self.commission_per) * self.commission_rate(units))
+        cost = cost + units * slippage
+
+        return float(cost) if np.ndim(cost) == 0 else cost
+
+    def __call__(self, units, bars=None):
+        return self.costs(units, bars)
+
+    def trade_costs(self, ledger):
+        """
+        Prices every fill of a ledger (LEDGER_DTYPE) with this model - one vectorized call for the whole simulation, example: the costs of a run under bid/ask spreads.
+
+        The backtests charge a buy on the units the capital could buy before the cost, a few more than the units bought, so buys come out slightly cheaper here than in the ledger. Sells are priced exactly.
+        """
+        return self.costs(ledger['units'], ledger['bar'])
+
+
+def trade_cost(cost_fn, units, bar):
+    """
+    Returns the cost of one trade (or an array of them) on bar - a CostModel is given the bar, any other cost function only the units.
+    """
+    if isinstance(cost_fn, CostModel):
+        return cost_fn.costs(units, bar)
+
+    return cost_fn(units)
+
+
 def omega_oanda_core_cost(h, spread=0.00002):
     """
     This function will return the cost per trade when using Oanda API. This will also assume a spread average of 0.00002 
     
-    In a real life trading scenario we will calculate the spread on the fly which will require ask, bid, mid for the time the trade is executed. This is related to the volume of the trade.
+    In a real life trading scenario we will calculate the spread on the fly which will require ask, bid, mid for the time the trade is executed. This is related to the volume of the trade - use a CostModel for spreads from bid/ask candles, commission schedules and slippage.
     
     ARGS:
-        h: <int> the number of shares owned
+        h: <int or numpy.array> the number of shares owned, one per trade
         spread: <float> the spread (ask - bid)
     """
     # cost of the spread
@@ -665,6 +822,8 @@ def margin_trade(margin, leverage=20):
     This will function will allow for margin trading which takes in the brokers leverage and how many assets you want to leverage which is the margin.
     
     Example: If your broker provides a 20:1 leverage, and your margin (down payment) is $1000, this means you will be able to use $20,000 in buying power
+
+    This only scales the capital - margin_trade_batch tracks the used margin and margin closeouts during a simulation.
     
     ARGS:
         leverage: <int> the multiplier
@@ -690,4 +849,743 @@ def calculate_margin_trade(low, high, h_lot, leverage=20):
     # calculating our margin, this is the minimum downpayment of the trade
     margin = (1/leverage) * h
     
-    return margin
\ No newline at end of file
+    return margin
+
+
+# parameter sweeps
+SIMULATIONS = {
+    'basic': simulate_thresh_test_trade_basic,
+    'trade': simulate_thresh_test_trade,
+    'best': simulate_thresh_test_trade_best,
+    'simple': simulate_thresh_test_trade_simple,
+}
+
+# per-process view of the shared price arrays
+sweep_state = {}
+
+
+def sweep_init(shm_name, shape, columns):
+    """
+    Pool initializer - attaches every worker to the shared memory block holding the open, close and change columns.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    sweep_state['shm'] = shm
+    sweep_state['data'] = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    sweep_state['columns'] = columns
+
+
+def sweep_worker(params):
+    """
+    Runs one simulation of the sweep on the shared arrays and returns its result row.
+    """
+    strategy, window, buy_threshold, sell_threshold, start_cap, margin_trading = params
+    data = sweep_state['data']
+    columns = sweep_state['columns']
+
+    sequence = pd.DataFrame({
+        'open': data[:, 0],
+        'close': data[:, 1],
+        str(window): data[:, columns.index(str(window))],
+    })
+
+    # keeping the workers quiet - every simulation logs its performance
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            if strategy == 'simple':
+                result = simulate_thresh_test_trade_simple(sequence, buy_threshold, start_cap, print_trades=False, margin_trading=margin_trading)
+            elif strategy == 'basic':
+                result = simulate_thresh_test_trade_basic(sequence, buy_threshold, sell_threshold, start_cap, print_trades=False)
+            else:
+                result = SIMULATIONS[strategy](sequence, buy_threshold, sell_threshold, start_cap, print_trades=False, margin_trading=margin_trading)
+
+    # one failing combination should not take down the whole sweep
+    except Exception:
+        result = (start_cap, np.nan, np.nan)
+
+    return {
+        'prediction_window': window,
+        'buy_threshold': buy_threshold,
+        'sell_threshold': sell_threshold,
+        'start_cap': result[0],
+        'end_cap': result[1],
+        'roi': result[2],
+    }
+
+
+def sweep_thresh_test_trade(changes_df, grid, start_cap, strategy='simple', margin_trading=False, processes=None, chunksize=1):
+    """
+    This function will run a simulation for every combination of a parameter grid (like test_dist in 2B_Data_Analysis) over a process pool. The open, close and change columns are copied once into shared memory, so the workers never pickle the price data.
+
+    ARGS:
+        changes_df: <pandas.DataFrame> should contain: open, close and one change column per prediction window, example: '24'. This is the changes_1hr_USDGBP.csv table
+        grid: <dict> parameter grid, example:
+            {
+                'prediction_window': [3, 6, 12, 24, 36, 48],
+                'buy_threshold': [0.002, 0.005, 0.01, 0.02],
+                'sell_threshold': [0.0, -0.002, -0.005, -0.01, -0.02]
+            }
+            sell_threshold is ignored by the 'simple' strategy
+        start_cap: <int or float> represents our starting capital
+        strategy: <string> 'basic', 'trade', 'best' or 'simple' - which simulate_thresh_test_trade* to run
+        margin_trading: <boolean> if True, every simulation is margin traded (ignored by 'basic')
+        processes: <int> number of worker processes, defaults to the number of cores
+        chunksize: <int> how many simulations are handed to a worker at once
+
+    RETURNS:
+        <pandas.DataFrame> one row per combination: prediction_window, buy_threshold, sell_threshold, start_cap, end_cap, roi
+        end_cap and roi are NaN for combinations whose simulation raised
+    """
+    if strategy not in SIMULATIONS:
+        raise ValueError(f'strategy must be one of {list(SIMULATIONS)}, got: {strategy}')
+
+    windows = [int(w) for w in grid['prediction_window']]
+    sell_thresholds = [None] if strategy == 'simple' else grid['sell_threshold']
+
+    # the change columns are strings when read back from csv
+    labels = {str(c): c for c in changes_df.columns}
+    columns = ['open', 'close'] + [str(w) for w in windows]
+    missing = [c for c in columns if c not in labels]
+    if missing:
+        raise KeyError(f'changes_df is missing the columns: {missing}')
+
+    # copying the arrays into shared memory once
+    values = changes_df[[labels[c] for c in columns]].to_numpy(dtype=np.float64)
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+
+    try:
+        data = np.ndarray(values.shape, dtype=np.float64, buffer=shm.buf)
+        data[:] = values
+
+        params = [
+            (strategy, w, b, s, start_cap, margin_trading)
+            for w, b, s in itertools.product(windows, grid['buy_threshold'], sell_thresholds)
+        ]
+
+        with mp.Pool(processes, initializer=sweep_init, initargs=(shm.name, values.shape, columns)) as pool:
+            rows = pool.map(sweep_worker, params, chunksize=chunksize)
+
+        del data
+
+    finally:
+        shm.close()
+        shm.unlink()
+
+    results = pd.DataFrame(rows)
+    if strategy == 'simple':
+        results = results.drop(columns='sell_threshold')
+
+    return results
+
+
+def simulate_thresh_test_trade_batch(sequence, buy_thresholds, sell_thresholds, start_cap, margin_trading=False, grid=True, metrics=False, periods_per_year=PERIODS_PER_YEAR, cost_model=None):
+    """
+    This function will run simulate_thresh_test_trade for many buy/sell thresholds at once using thresh_trade_batch - one pass over the sequence for all of them. Use this for dense threshold surfaces over a changes_df window.
+
+    ARGS:
+        sequence: <pandas.DataFrame> should contain: open, close, percentage change: example ['24'] represent percent change in 24 hour window.
+        buy_thresholds: <list or numpy.array> buy thresholds to test
+        sell_thresholds: <list or numpy.array> sell thresholds to test
+        start_cap: <int or float> represents our starting capital
+        margin_trading: <boolean> if True, the starting capital is leveraged with margin_trade
+        grid: <boolean> if True, every buy threshold is tested against every sell threshold. If False, the thresholds are taken as pairs
+        metrics: <boolean> if True, the risk metrics of omega_metrics.risk_metrics are added to the results
+        periods_per_year: <int> bars in a year, used to annualize the metrics
+        cost_model: <CostModel> transaction costs, example: CostModel.from_bid_ask over the bid/ask candles of sequence - defaults to omega_oanda_core_cost
+
+    RETURNS:
+        results, equity
+
+        results: <pandas.DataFrame> one row per parameter set: buy_threshold, sell_threshold, start_cap, end_cap, roi, transaction_cost (+ sharpe, sortino, max_drawdown ... if metrics)
+        equity: <numpy.array> one equity curve per parameter set, shape (params, bars)
+    """
+    change_window = sequence.columns[2] # column with change window size
+
+    if grid:
+        buy_thresholds, sell_thresholds = np.meshgrid(buy_thresholds, sell_thresholds, indexing='ij')
+
+    buy_thresholds = np.ravel(buy_thresholds)
+    sell_thresholds = np.ravel(sell_thresholds)
+
+    bc = margin_trade(start_cap) if margin_trading else start_cap
+    cost_model = cost_model or CostModel()
+
+    bc, h, total_transaction_costs, tnf, equity, position = thresh_trade_batch(
+        sequence['open'].values, sequence[change_window].values, change_window,
+        buy_thresholds, sell_thresholds, bc, cost_fn=cost_model, return_position=True
+    )
+
+    # same end of simulation sell off as simulate_thresh_test_trade - priced on the last bar
+    sell_off = (bc > 0) & (bc < 100) & (h > 0)
+    if sell_off.any():
+        core_cost = cost_model.costs(h[sell_off], len(sequence) - 1)
+        bc[sell_off] += (h[sell_off] * tnf[sell_off]) - core_cost
+        total_transaction_costs[sell_off] += core_cost
+
+    roi = np.trunc(((bc - start_cap) / start_cap) * 100)
+
+    results = pd.DataFrame({
+        'change_window': change_window,
+        'buy_threshold': buy_thresholds,
+        'sell_threshold': sell_thresholds,
+        'start_cap': start_cap,
+        'end_cap': bc,
+        'roi': roi,
+        'transaction_cost': total_transaction_costs,
+    })
+
+    if metrics:
+        results = pd.concat([results, risk_metrics(equity, position, periods_per_year=periods_per_year)], axis=1)
+
+    return results, equity
+
+
+# leveraged account
+def margin_trade_batch(open_, signal, change_window, buy_thresholds, sell_thresholds, leverages, start_cap, low_=None, cost_fn=None, margin_closeout=0.5, return_account=False):
+    """
+    This is thresh_trade_batch on a leveraged margin account - the start_cap is the deposit (not multiplied like margin_trade) and every buy takes as many units as the balance times the leverage allows. Every parameter set has its own leverage, so leverage levels are swept alongside the thresholds in the same single pass.
+
+    The account of every parameter set is kept as arrays and checked on every bar, like Oanda does:
+        unrealized P&L = units * (price - entry price)
+        NAV = balance + unrealized P&L
+        used margin = units * price / leverage
+        closeout level = NAV / used margin
+
+    Positions held coming into a bar are checked at the worst price of the bar (low_) if given, the open otherwise, before trading - positions opened on the bar are checked at its low too, and a sell filled at a later open is checked against every bar it is held through. A position whose closeout level falls under margin_closeout is liquidated at the closeout price (where the level hits margin_closeout), or at the open if the bar gapped through it, so losses stay within the margin unless prices gap. Liquidations are recorded in the ledger with the LIQUIDATION side and no buy happens on that bar.
+
+    ARGS:
+        open_: <numpy.array> opening prices, shape (bars,)
+        signal: <numpy.array> percentage change values of the change window, shape (bars,)
+        change_window: <int or string> the change window size, example: '24'
+        buy_thresholds: <numpy.array> one buy threshold per parameter set, shape (params,)
+        sell_thresholds: <numpy.array> one sell threshold per parameter set, shape (params,)
+        leverages: <numpy.array> one leverage per parameter set, example: 20 for 20:1, shape (params,)
+        start_cap: <int or float> the deposit of every account
+        low_: <numpy.array> lowest prices, shape (bars,) - the margin check uses the open if None
+        cost_fn: <function or CostModel> transaction cost given an array of shares, example: omega_oanda_core_cost. None means no cost
+        margin_closeout: <float> the closeout level under which positions are liquidated, Oanda uses 0.5
+        return_account: <boolean> if True, the used margin, unrealized P&L and closeout level of every bar are returned too
+
+    RETURNS:
+        balance, h, total_transaction_costs, min_closeout, equity, position, ledger (, account)
+
+        balance, h, total_transaction_costs and min_closeout (lowest closeout level reached, NaN if never in a position) have shape (params,)
+        equity is the NAV marked to the open of every bar after trading, position is True on the bars a position is held, shape (params, bars)
+        ledger is a MARGIN_LEDGER_DTYPE structured array of every fill, grouped by parameter set in time order - capital is the balance after the fill
+        account is a dict of (params, bars) arrays marked to the open after trading: used_margin, unrealized_pl, closeout_level (NaN when flat)
+    """
+    open_ = np.asarray(open_, dtype=np.float64)
+    signal = np.asarray(signal, dtype=np.float64)
+    mark = open_ if low_ is None else np.asarray(low_, dtype=np.float64)
+    buy_thresholds = np.asarray(buy_thresholds, dtype=np.float64)
+    x_s = -np.asarray(sell_thresholds, dtype=np.float64)
+    leverages = np.asarray(leverages, dtype=np.float64)
+
+    if not buy_thresholds.shape == x_s.shape == leverages.shape:
+        raise ValueError('buy_thresholds, sell_thresholds and leverages must have the same shape')
+
+    n = len(open_)
+    if isinstance(cost_fn, CostModel):
+        cost_fn.check_bars(n)
+    p = len(buy_thresholds)
+    window_size = int(change_window)
+    params = np.arange(p)
+
+    # account state for every parameter set
+    balance = np.full(p, start_cap, dtype=np.float64)
+    h = np.zeros(p, dtype=np.float64)
+    cost_basis = np.zeros(p, dtype=np.float64) # units * entry price of the open positions
+    total_transaction_costs = np.zeros(p, dtype=np.float64)
+    min_closeout = np.full(p, np.inf)
+    fills = []
+
+    # bar-major while simulating so every bar writes one contiguous row, transposed at the end
+    equity = np.empty((n, p), dtype=np.float64)
+    position = np.empty((n, p), dtype=bool)
+    if return_account:
+        account = {name: np.empty((n, p), dtype=np.float64) for name in ('used_margin', 'unrealized_pl', 'closeout_level')}
+
+    # fills are kept as columns and turned into a ledger once at the end
+    def record(mask, bar, side, price, core_cost):
+        rows = params[mask]
+        fills.append((rows, bar, side, price, h[mask], core_cost, balance[mask]))
+
+    def closeout_price(mask):
+        # the price where the closeout level of a position hits margin_closeout - fixed while it is held
+        return (cost_basis[mask] - balance[mask]) / (h[mask] * (1 - margin_closeout / leverages[mask]))
+
+    def liquidate(mask, bars, price):
+        units = h[mask]
+        basis = cost_basis[mask]
+        level = (balance[mask] + units * price - basis) * leverages[mask] / (units * price)
+
+        core_cost = 0
+        if cost_fn is not None:
+            core_cost = trade_cost(cost_fn, units, bars)
+            total_transaction_costs[mask] += core_cost
+
+        balance[mask] += units * price - basis - core_cost
+        record(mask, bars, LIQUIDATION, price, core_cost)
+        h[mask] = 0
+        cost_basis[mask] = 0
+
+        return level
+
+    def margin_check(candidates, i):
+        # flat accounts and the ones not checked are at an infinite level
+        value = h * mark[i]
+        level = np.where(candidates, (balance + value - cost_basis) * leverages / value, np.inf)
+        closeout = level < margin_closeout
+
+        # liquidating at the closeout price, or at the open if the bar gapped through it
+        if closeout.any():
+            level[closeout] = liquidate(closeout, i, np.minimum(closeout_price(closeout), open_[i]))
+
+        np.minimum(min_closeout, level, out=min_closeout)
+
+        return closeout
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(n):
+            end = min(i + window_size, n - 1)
+            change = signal[end]
+
+            # margin check of the positions held coming into the bar
+            closeout = margin_check(h > 0, i)
+
+            # buying trade if buy threshold met
+            buy = (change >= buy_thresholds) & (balance > 0) & (h == 0) & ~closeout
+
+            # selling assets if sell threshold is met
+            sell = ~buy & (change <= x_s) & (h > 0) & (end > i)
+
+            if buy.any():
+                tni = open_[i]
+
+                core_cost = 0
+                if cost_fn is not None:
+                    core_cost = trade_cost(cost_fn, np.floor(balance[buy] * leverages[buy] / tni), i)
+                    total_transaction_costs[buy] += core_cost
+                    balance[buy] -= core_cost
+
+                h[buy] = np.floor(balance[buy] * leverages[buy] / tni)
+                cost_basis[buy] = h[buy] * tni
+                record(buy, i, BUY, tni, core_cost)
+
+                # the low of the entry bar comes after the buy at its open
+                if low_ is not None:
+                    margin_check(buy, i)
+
+            # a sell fills at the open of end - 1 - positions reaching their closeout price on the bars before are liquidated there instead
+            if sell.any() and end - 1 > i:
+                path = np.append(mark[i + 1:end - 1], open_[end - 1])
+                hit = path < closeout_price(sell)[:, None]
+                breached = hit.any(axis=1)
+
+                if breached.any():
+                    rows = np.flatnonzero(sell)[breached]
+                    bars = i + 1 + hit[breached].argmax(axis=1)
+                    stopped = np.zeros(p, dtype=bool)
+                    stopped[rows] = True
+
+                    level = liquidate(stopped, bars, np.minimum(closeout_price(stopped), open_[bars]))
+                    min_closeout[rows] = np.minimum(min_closeout[rows], level)
+                    sell &= ~stopped
+
+            if sell.any():
+                tnf = open_[end - 1]
+
+                core_cost = 0
+                if cost_fn is not None:
+                    core_cost = trade_cost(cost_fn, h[sell], end - 1)
+                    total_transaction_costs[sell] += core_cost
+
+                balance[sell] += h[sell] * tnf - cost_basis[sell] - core_cost
+                record(sell, end - 1, SELL, tnf, core_cost)
+                h[sell] = 0
+                cost_basis[sell] = 0
+
+            unrealized_pl = h * open_[i] - cost_basis
+            equity[i] = balance + unrealized_pl
+            position[i] = h > 0
+
+            if return_account:
+                used_margin = h * open_[i] / leverages
+                account['used_margin'][i] = used_margin
+                account['unrealized_pl'][i] = unrealized_pl
+                account['closeout_level'][i] = np.where(h > 0, equity[i] / used_margin, np.nan)
+
+    min_closeout[np.isinf(min_closeout)] = np.nan
+    equity = np.ascontiguousarray(equity.T)
+    position = np.ascontiguousarray(position.T)
+
+    counts = [len(fill[0]) for fill in fills]
+    ledger = np.empty(sum(counts), dtype=MARGIN_LEDGER_DTYPE)
+    if fills:
+        for k, name in enumerate(('param', 'bar', 'side', 'price', 'units', 'cost', 'capital')):
+            ledger[name] = np.concatenate([np.broadcast_to(fill[k], (count,)) for fill, count in zip(fills, counts)])
+    ledger['sell_thresh'] = np.nan
+    ledger = ledger[np.argsort(ledger['param'], kind='stable')]
+
+    if return_account:
+        account = {name: np.ascontiguousarray(values.T) for name, values in account.items()}
+        return balance, h, total_transaction_costs, min_closeout, equity, position, ledger, account
+
+    return balance, h, total_transaction_costs, min_closeout, equity, position, ledger
+
+
+def simulate_margin_batch(sequence, buy_thresholds, sell_thresholds, leverages, start_cap, grid=True, cost_model=None, margin_closeout=0.5, metrics=False, periods_per_year=PERIODS_PER_YEAR):
+    """
+    This function will run simulate_thresh_test_trade on a leveraged margin account for many buy thresholds, sell thresholds and leverages at once using margin_trade_batch - one pass over the sequence for all of them.
+
+    ARGS:
+        sequence: <pandas.DataFrame> should contain: open, close, percentage change: example ['24'] represent percent change in 24 hour window. The margin check uses the low column if there is one, the lower of open and close otherwise
+        buy_thresholds: <list or numpy.array> buy thresholds to test
+        sell_thresholds: <list or numpy.array> sell thresholds to test
+        leverages: <list or numpy.array> leverages to test, example: [1, 10, 20, 50]
+        start_cap: <int or float> the deposit
+        grid: <boolean> if True, every combination of buy threshold, sell threshold and leverage is tested. If False, they are taken as triples
+        cost_model: <CostModel> transaction costs - defaults to omega_oanda_core_cost
+        margin_closeout: <float> the closeout level under which positions are liquidated
+        metrics: <boolean> if True, the risk metrics of omega_metrics.risk_metrics are added to the results
+        periods_per_year: <int> bars in a year, used to annualize the metrics
+
+    RETURNS:
+        results, equity, ledger
+
+        results: <pandas.DataFrame> one row per parameter set: buy_threshold, sell_threshold, leverage, start_cap, end_cap, roi, transaction_cost, liquidations, min_closeout_level (+ sharpe, sortino, max_drawdown ... if metrics)
+        equity: <numpy.array> the NAV of every parameter set, shape (params, bars)
+        ledger: <numpy.array> MARGIN_LEDGER_DTYPE fills of every parameter set
+    """
+    change_window = sequence.columns[2] # column with change window size
+
+    if grid:
+        buy_thresholds, sell_thresholds, leverages = np.meshgrid(buy_thresholds, sell_thresholds, leverages, indexing='ij')
+
+    buy_thresholds = np.ravel(buy_thresholds)
+    sell_thresholds = np.ravel(sell_thresholds)
+    leverages = np.ravel(leverages)
+
+    cost_model = cost_model or CostModel()
+    low_ = sequence['low'].values if 'low' in sequence.columns else np.minimum(sequence['open'].values, sequence['close'].values)
+
+    balance, h, total_transaction_costs, min_closeout, equity, position, ledger = margin_trade_batch(
+        sequence['open'].values, sequence[change_window].values, change_window,
+        buy_thresholds, sell_thresholds, leverages, start_cap, low_=low_, cost_fn=cost_model, margin_closeout=margin_closeout
+    )
+
+    # closing what is still open at the last open, like the end of simulation sell off of simulate_thresh_test_trade
+    end_cap = equity[:, -1].copy()
+    if (h > 0).any():
+        core_cost = cost_model.costs(h[h > 0], len(sequence) - 1)
+        end_cap[h > 0] -= core_cost
+        total_transaction_costs[h > 0] += core_cost
+
+    results = pd.DataFrame({
+        'change_window': change_window,
+        'buy_threshold': buy_thresholds,
+        'sell_threshold': sell_thresholds,
+        'leverage': leverages,
+        'start_cap': start_cap,
+        'end_cap': end_cap,
+        'roi': np.trunc(((end_cap - start_cap) / start_cap) * 100),
+        'transaction_cost': total_transaction_costs,
+        'liquidations': np.bincount(ledger['param'][ledger['side'] == LIQUIDATION], minlength=len(leverages)),
+        'min_closeout_level': min_closeout,
+    })
+
+    if metrics:
+        results = pd.concat([results, risk_metrics(equity, position, periods_per_year=periods_per_year)], axis=1)
+
+    return results, equity, ledger
+
+
+# streaming backtest
+class StreamBacktest:
+    """
+    This is thresh_trade_engine turned inside out: instead of taking whole arrays, it is fed one candle at a time (from a file iterator, a download, or a live feed) and emits every fill as soon as it is decided. Only the last change_window + 1 candles are kept, so memory stays the same whatever the length of the history.
+
+    By default it replays history: the decision for bar i needs the change at bar i + change_window, so bar i is decided when that candle arrives and its fills come out change_window candles late, dated back to bar i - exactly the trades thresh_trade_engine makes on the same series. Call finish at the end of the stream to decide the last change_window bars against the last candle, like the engine does. As in thresh_trade_batch, a sell triggered on the very last bar keeps the position open instead of raising.
+
+    Replay is only for backtests - a signal given with candle t would fill at the open of bar t - change_window. With live=True the change given with a candle is the signal for that candle and every fill is at that candle's open (or mid): buy when it is over buy_threshold, and exit on the signal dropping under -sell_threshold, on the open dropping under the stop set from the entry price, or at the open change_window candles after the entry, for the 'signal', 'stop' and 'window' exit rules. finish has nothing left to decide in live mode.
+
+    The change is taken from the candle if given (the signal of a model), otherwise computed from the buffer like omega_analysis.return_open_close_range_change: (open[t] - close[t - change_window]) / close[t - change_window].
+
+    ARGS:
+        change_window: <int or string> the change window size, example: '24'
+        buy_threshold: <float> how much % of a change must there be for this to be a buy
+        sell_threshold: <float> how much % of a drop must there be for this to be a sell
+        start_cap: <int or float> our starting capital (already leveraged if margin trading)
+        entry: <string> 'open' or 'mid', see thresh_trade_engine
+        exit_rule: <string> 'signal', 'stop' or 'window', see thresh_trade_engine
+        cost_fn: <function or CostModel> transaction cost per trade given the number of shares, example: omega_oanda_core_cost. A CostModel is given the bar of the trade too. None means no cost
+        on_fill: <function> called with every fill as it happens
+        live: <boolean> if True, trade on the current candle instead of replaying with parity to thresh_trade_engine
+        keep_fills: <None, boolean or int> fills kept for ledger() - True keeps all of them, False none, an int the last keep_fills. None keeps all of them only when there is no on_fill, so a stream handing its fills on stays in constant memory
+
+    Fills are (bar, side, price, units, cost, capital, sell_thresh) tuples in the order of LEDGER_DTYPE - ledger() returns the ones kept as the same structured array as thresh_trade_engine, so log_trades prints them.
+    """
+    def __init__(self, change_window, buy_threshold, sell_threshold, start_cap, entry='open', exit_rule='signal', cost_fn=None, on_fill=None, live=False, keep_fills=None):
+        self.window_size = int(change_window)
+        self.buy_threshold = buy_threshold
+        self.x_s = -sell_threshold
+        self.entry = entry
+        self.exit_rule = exit_rule
+        self.cost_fn = cost_fn
+        self.on_fill = on_fill
+        self.live = live
+
+        # rolling state - (open, close, change) of the last window_size + 1 candles
+        self.candles = collections.deque(maxlen=self.window_size + 1)
+        self.bars = 0
+        self.next_bar = 0 # next bar to decide
+        self.skip_to = 0 # the 'window' exit rule jumps ahead after a trade
+
+        self.bc = start_cap
+        self.h = 0
+        self.tni = None
+        self.tnf = None
+        self.sell_thresh = 0
+        self.core_cost = 0
+        self.total_transaction_costs = 0
+
+        # the fills kept for ledger()
+        if keep_fills is None:
+            keep_fills = on_fill is None
+        if keep_fills is True:
+            self.fills = collections.deque()
+        else:
+            self.fills = collections.deque(maxlen=int(keep_fills))
+
+    def candle(self, bar):
+        """
+        Returns (open, close, change) of a bar still in the buffer.
+        """
+        return self.candles[bar - (self.bars - len(self.candles))]
+
+    def update(self, open_, close, change=None):
+        """
+        Feeds the next candle.
+
+        ARGS:
+            open_: <float> open of the candle
+            close: <float> close of the candle
+            change: <float> change of the window ending on this candle, computed from the buffer if None
+
+        RETURNS:
+            <list> the fills decided on this candle
+        """
+        if change is None:
+            if self.window_size == 0:
+                change = (open_ - close) / close
+            elif len(self.candles) >= self.window_size:
+                prev_close = self.candles[len(self.candles) - self.window_size][1]
+                change = (open_ - prev_close) / prev_close
+            else:
+                change = math.nan
+
+        self.candles.append((float(open_), float(close), float(change)))
+        self.bars += 1
+
+        # trading on this candle
+        if self.live:
+            self.next_bar = self.bars
+            return self.decide_live(self.bars - 1)
+
+        # the bar whose window ends on this candle
+        fills = []
+        if self.bars - 1 - self.window_size >= self.next_bar:
+            fills = self.decide(self.next_bar, self.bars - 1)
+            self.next_bar += 1
+
+        return fills
+
+    def finish(self):
+        """
+        Ends the stream - decides the bars left, with their window clipped to the last candle.
+
+        RETURNS:
+            <list> the fills decided
+        """
+        fills = []
+        while self.next_bar < self.bars:
+            fills += self.decide(self.next_bar, self.bars - 1)
+            self.next_bar += 1
+
+        return fills
+
+    def fill(self, fills, side, bar, price, sell_thresh=math.nan):
+        """
+        Records a fill and hands it to on_fill.
+        """
+        fill = (bar, side, price, self.h, self.core_cost, self.bc, sell_thresh)
+        fills.append(fill)
+        self.fills.append(fill)
+        if self.on_fill is not None:
+            self.on_fill(fill)
+
+    def decide(self, i, end):
+        """
+        One step of thresh_trade_engine for bar i, with the window ending at end.
+        """
+        fills = []
+        self.core_cost = 0
+
+        if i < self.skip_to:
+            return fills
+
+        open_i, close_i, _ = self.candle(i)
+        open_end, _, change = self.candle(end)
+
+        # buying trade if buy threshold met
+        if change >= self.buy_threshold and self.bc > 0 and self.h == 0:
+            self.tni = (open_i + close_i) / 2 if self.entry == 'mid' else open_i
+
+            # charging the cost of the trade before buying
+            if self.cost_fn is not None:
+                self.core_cost = trade_cost(self.cost_fn, math.floor(self.bc / self.tni), i)
+                self.total_transaction_costs += self.core_cost
+                self.bc = self.bc - self.core_cost
+
+            self.h = math.floor(self.bc / self.tni)
+
+            # initializing our sell threshold
+            if self.exit_rule == 'stop':
+                self.sell_thresh = open_end + (open_end * self.x_s)
+
+            self.bc = self.bc - (self.h * self.tni)
+            self.fill(fills, BUY, i, self.tni, self.sell_thresh if self.exit_rule == 'stop' else math.nan)
+
+            # SIMPLE - selling at the end of the window, then jumping ahead of it
+            if self.exit_rule == 'window':
+                self.bc = self.bc + (self.h * open_end)
+
+                self.core_cost = 0
+                if self.cost_fn is not None:
+                    self.core_cost = trade_cost(self.cost_fn, self.h, end)
+                    self.total_transaction_costs += self.core_cost
+                    self.bc = self.bc - self.core_cost
+
+                self.fill(fills, SELL, end, open_end)
+                self.h = 0
+                self.skip_to = i + self.window_size
+
+        # selling assets if sell threshold is met
+        elif self.exit_rule != 'window' and (change <= self.x_s if self.exit_rule == 'signal' else open_end <= self.sell_thresh) and self.h > 0 and end > i:
+            self.tnf = self.candle(end - 1)[0] # selling at open
+            self.bc = self.bc + (self.h * self.tnf)
+
+            if self.cost_fn is not None:
+                self.core_cost = trade_cost(self.cost_fn, self.h, end - 1)
+                self.total_transaction_costs += self.core_cost
+                self.bc = self.bc - self.core_cost
+
+            self.fill(fills, SELL, end - 1, self.tnf)
+            self.h = 0
+
+        return fills
+
+    def sell(self, fills, bar, price):
+        """
+        Sells the whole position at price on bar.
+        """
+        self.tnf = price
+        self.bc = self.bc + (self.h * self.tnf)
+
+        self.core_cost = 0
+        if self.cost_fn is not None:
+            self.core_cost = trade_cost(self.cost_fn, self.h, bar)
+            self.total_transaction_costs += self.core_cost
+            self.bc = self.bc - self.core_cost
+
+        self.fill(fills, SELL, bar, self.tnf)
+        self.h = 0
+
+    def decide_live(self, t):
+        """
+        The live step - trades bar t on its own change.
+        """
+        fills = []
+        self.core_cost = 0
+
+        open_t, close_t, change = self.candle(t)
+
+        # WINDOW - selling at the open once the window of the entry is over
+        if self.exit_rule == 'window' and self.h > 0 and t >= self.skip_to:
+            self.sell(fills, t, open_t)
+
+        # buying trade if buy threshold met
+        if change >= self.buy_threshold and self.bc > 0 and self.h == 0:
+            self.tni = (open_t + close_t) / 2 if self.entry == 'mid' else open_t
+
+            # charging the cost of the trade before buying
+            self.core_cost = 0
+            if self.cost_fn is not None:
+                self.core_cost = trade_cost(self.cost_fn, math.floor(self.bc / self.tni), t)
+                self.total_transaction_costs += self.core_cost
+                self.bc = self.bc - self.core_cost
+
+            self.h = math.floor(self.bc / self.tni)
+
+            # the stop is set from the entry price, the future open is not known yet
+            if self.exit_rule == 'stop':
+                self.sell_thresh = self.tni + (self.tni * self.x_s)
+
+            self.bc = self.bc - (self.h * self.tni)
+            self.fill(fills, BUY, t, self.tni, self.sell_thresh if self.exit_rule == 'stop' else math.nan)
+
+            # a window of 0 is bought and sold on the same candle
+            if self.exit_rule == 'window':
+                self.skip_to = t + self.window_size
+                if self.window_size == 0:
+                    self.sell(fills, t, open_t)
+
+        # selling assets if sell threshold is met
+        elif self.h > 0 and ((self.exit_rule == 'signal' and change <= self.x_s) or (self.exit_rule == 'stop' and open_t <= self.sell_thresh)):
+            self.sell(fills, t, open_t)
+
+        return fills
+
+    def result(self):
+        """
+        RETURNS:
+            bc, h, total_transaction_costs, tni, tnf - like thresh_trade_engine
+        """
+        return self.bc, self.h, self.total_transaction_costs, self.tni, self.tnf
+
+    def ledger(self):
+        """
+        Returns the fills kept so far (see keep_fills) as a LEDGER_DTYPE structured array.
+        """
+        return np.array(list(self.fills), dtype=LEDGER_DTYPE)
+
+
+def simulate_stream(candles, change_window, buy_threshold, sell_threshold, start_cap, entry='open', exit_rule='signal', cost_fn=omega_oanda_core_cost, print_trades=True, live=False):
+    """
+    This function runs a StreamBacktest over any iterable of candles - omega_candles.iter_candles over a raw file, or a live feed - and prints every fill as it happens.
+
+    ARGS:
+        candles: <iterable> (open, close) or (open, close, change) tuples
+        change_window: <int or string> the change window size, example: '24'
+        buy_threshold: <float> how much % of a change must there be for this to be a buy
+        sell_threshold: <float> how much % of a drop must there be for this to be a sell
+        start_cap: <int or float> our starting capital
+        entry: <string> 'open' or 'mid', see thresh_trade_engine
+        exit_rule: <string> 'signal', 'stop' or 'window', see thresh_trade_engine
+        cost_fn: <function or CostModel> transaction cost per trade, None means no cost
+        print_trades: <boolean> if True, every fill is printed when it is decided
+        live: <boolean> if True, trade on the current candle instead of replaying, see StreamBacktest
+
+    RETURNS:
+        bc, h, total_transaction_costs, tni, tnf
+    """
+    def print_fill(fill):
+        bar, side, price, h, core_cost, capital, _ = fill
+        print(f'{SIDES[side]} - bar: {bar} price: {price} shares: {h} cost: {core_cost} capital: {capital}')
+
+    backtest = StreamBacktest(change_window, buy_threshold, sell_threshold, start_cap, entry=entry, exit_rule=exit_rule, cost_fn=cost_fn, on_fill=print_fill if print_trades else None, live=live, keep_fills=False)
+
+    for candle in candles:
+        backtest.update(*candle)
+    backtest.finish()
+
+    return backtest.result()
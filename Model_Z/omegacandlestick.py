@@ -2,23 +2,37 @@ from tqdm import tqdm
 import pandas as pd
 import numpy as np
 import os
+import sys
 import matplotlib.pyplot as plt
-import gc
+
+# resource is unix only, psutil is optional - peak_rss uses whichever is there
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 from mpl_finance import candlestick_ohlc
 import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from pandas.plotting import register_matplotlib_converters
 
-from time import sleep
 import multiprocessing as mp
 
+from omega_shards import ShardWriter, RenderCache, LABELS, window_key, save_keys
+
 # instantiating pandas.plotting
 register_matplotlib_converters()
 
 # batch split into two
 def batch_split_two(df_):
     """
-    This is a simple function that will split a large df into two different dataframes in half. Considering Used mainly for testing
+    This is a simple function that will split a large df into two different dataframes in half. Considering Used mainly for testing - use generate_images to shard a dataset over every core
     ARGS:
         df_: <pandas dataframe object> - time series dataframe
     """
@@ -29,13 +43,174 @@ def batch_split_two(df_):
     df1 = df_.iloc[:batch_size].copy()
     df2 = df_.iloc[batch_size:].copy()
     
-    # converting dates into floats for ohlc
-    df1['date'] = [mdates.date2num(d) for d in df1['date']]
-    df2['date'] = [mdates.date2num(d) for d in df2['date']]
+    # converting dates into floats for ohlc - one vectorized call per half
+    df1['date'] = mdates.date2num(df1['date'].values)
+    df2['date'] = mdates.date2num(df2['date'].values)
     
     # returning
     return df1, df2
 
+
+
+# quotes
+def quote_array(df_):
+    """
+    This function converts a whole dataframe into the (N, 5) float array of quotes candlestick_ohlc and render_candles take - date, open, high, low, close. Dates are converted with one vectorized mdates.date2num call (skipped if they are floats already), so the quotes of any window are just a view: quotes[start:start + window_size]
+    
+    ARGS:
+        df_: <pandas dataframe object> - date, open, high, low, close - date as datetime or float (mdates.date2num)
+        
+    RETURNS:
+        <numpy array> - (N, 5) float64
+    """
+    date = df_['date'].values
+    if not np.issubdtype(date.dtype, np.number):
+        date = mdates.date2num(date)
+    
+    # preallocated and filled column by column
+    quotes = np.empty((len(df_), 5), dtype=np.float64)
+    quotes[:, 0] = date
+    for k, column in enumerate(['open', 'high', 'low', 'close'], 1):
+        quotes[:, k] = df_[column].values
+        
+    return quotes
+
+
+# rasterizer
+def rasterize_windows(windows, candle_size=0.022, height=480, width=640, colorup=(0, 128, 0), colordown=(255, 0, 0)):
+    """
+    This function draws a stack of candlestick windows straight into uint8 images - no matplotlib figure, no PNG round trip. It mimics the style of the plots in save_images_multi: candlestick_ohlc with colorup='g', colordown='r', axis off, on the default 640x480 figure at 100 dpi.
+    
+    Every step is an array operation over all candles of all windows at once: the prices of every window are min/max scaled into matplotlib's default axes box (with its 5% margins), every pixel column of every window is assigned the candle body or wick covering it, and the images are filled from the per column top/bottom rows in one broadcast.
+    
+    ARGS:
+        windows: <numpy array> - (K, window_size, 5) date, open, high, low, close - date as float days (mdates.date2num)
+        candle_size: <float> - the size of each candle, in days like candlestick_ohlc's width
+        height: <int> - image height in pixels
+        width: <int> - image width in pixels
+        colorup: <tuple> - RGB of a candle where close >= open
+        colordown: <tuple> - RGB of a candle where close < open
+        
+    RETURNS:
+        <numpy array> - (K, height, width, 3) uint8 RGB images
+    """
+    windows = np.asarray(windows, dtype=np.float64)
+    K, n = windows.shape[:2]
+    date, open_, high, low, close = windows[..., 0], windows[..., 1], windows[..., 2], windows[..., 3], windows[..., 4]
+    offset = candle_size / 2
+    
+    # data limits plus matplotlib's 5% margins - (K, 1) per window
+    x_min, x_max = date.min(axis=1, keepdims=True) - offset, date.max(axis=1, keepdims=True) + offset
+    y_min, y_max = low.min(axis=1, keepdims=True), high.max(axis=1, keepdims=True)
+    x_pad = (x_max - x_min) * 0.05
+    x_pad = np.where(x_pad == 0, offset, x_pad)
+    y_pad = (y_max - y_min) * 0.05
+    y_pad = np.where(y_pad == 0, np.maximum(np.abs(y_max) * 0.05, 1e-9), y_pad)
+    x_min, x_max = x_min - x_pad, x_max + x_pad
+    y_min, y_max = y_min - y_pad, y_max + y_pad
+    
+    # default subplot box: left=0.125, right=0.9, top=0.88 - autofmt_xdate moves the bottom up to 0.2
+    left, right = 0.125 * width, 0.9 * width
+    top, bottom = (1 - 0.88) * height, (1 - 0.2) * height
+    
+    # scaling prices into pixel columns and rows (row 0 is the top)
+    to_col = lambda x: left + (x - x_min) / (x_max - x_min) * (right - left)
+    to_row = lambda y: bottom - (y - y_min) / (y_max - y_min) * (bottom - top)
+    
+    # the body edge line (1pt at 100 dpi) sticks out ~0.7 pixels on every side
+    edge = 0.5 * 100 / 72
+    body_left = to_col(date - offset) - edge
+    body_right = to_col(date + offset) + edge
+    body_top = np.floor(to_row(np.maximum(open_, close)) - edge)
+    body_bottom = np.maximum(np.ceil(to_row(np.minimum(open_, close)) + edge) - 1, body_top)
+    wick_col = np.floor(to_col(date)).astype(np.int64)
+    wick_top = np.floor(to_row(high))
+    wick_bottom = np.maximum(np.ceil(to_row(low)) - 1, wick_top)
+    up = close >= open_
+    
+    # which candle body covers each pixel column - one searchsorted over every window, each shifted 4 widths apart
+    shift = 4 * width * np.arange(K)[:, None]
+    cols = np.arange(width) + 0.5
+    candle = np.searchsorted((body_left + shift).ravel(), (cols + shift).ravel(), side='right').reshape(K, width) - 1
+    candle = np.clip(candle - n * np.arange(K)[:, None], 0, n - 1)
+    take = lambda values: np.take_along_axis(values, candle, axis=1)
+    in_body = (cols >= take(body_left)) & (cols < take(body_right))
+    
+    col_top = np.where(in_body, take(body_top), height).ravel()
+    col_bottom = np.where(in_body, take(body_bottom), -1).ravel()
+    col_up = take(up).ravel()
+    
+    # wicks run from high to low over the body
+    on_canvas = (wick_col >= 0) & (wick_col < width)
+    flat = (wick_col + width * np.arange(K)[:, None])[on_canvas]
+    col_top[flat] = np.minimum(col_top[flat], wick_top[on_canvas])
+    col_bottom[flat] = np.maximum(col_bottom[flat], wick_bottom[on_canvas])
+    col_up[flat] = up[on_canvas]
+    
+    # every column is one vertical run of pixels - only those are written over the white background
+    run_top = np.maximum(col_top, 0).astype(np.int64)
+    run_length = np.maximum(np.minimum(col_bottom, height - 1).astype(np.int64) - run_top + 1, 0)
+    
+    # flat pixel of every run start, then every pixel of every run in one repeat
+    column = np.arange(K * width)
+    run_start = (column // width) * height * width + run_top * width + column % width
+    run_offset = np.cumsum(run_length) - run_length
+    pixels = np.repeat(run_start, run_length) + width * (np.arange(run_length.sum()) - np.repeat(run_offset, run_length))
+    
+    colors = np.where(col_up[:, None], np.array(colorup, dtype=np.uint8), np.array(colordown, dtype=np.uint8))
+    
+    images = np.full((K, height, width, 3), 255, dtype=np.uint8)
+    images.reshape(-1, 3)[pixels] = np.repeat(colors, run_length, axis=0)
+    
+    return images
+
+
+def render_candles(quotes, candle_size=0.022, height=480, width=640, colorup=(0, 128, 0), colordown=(255, 0, 0)):
+    """
+    This function draws one candlestick window straight into a uint8 image - see rasterize_windows.
+    
+    ARGS:
+        quotes: <numpy array> - (window_size, 5) date, open, high, low, close - date as float days (mdates.date2num)
+        candle_size: <float> - the size of each candle, in days like candlestick_ohlc's width
+        height: <int> - image height in pixels
+        width: <int> - image width in pixels
+        colorup: <tuple> - RGB of a candle where close >= open
+        colordown: <tuple> - RGB of a candle where close < open
+        
+    RETURNS:
+        <numpy array> - (height, width, 3) uint8 RGB image
+    """
+    return rasterize_windows(np.asarray(quotes, dtype=np.float64)[None], candle_size, height, width, colorup, colordown)[0]
+
+
+def render_windows(quotes, starts, window_size=15, candle_size=0.022, height=480, width=640, colorup=(0, 128, 0), colordown=(255, 0, 0), chunk_size=64):
+    """
+    This function renders many windows of one series at once - the batch version of render_candles. The windows are gathered from the quotes array chunk by chunk and every chunk is drawn with one rasterize_windows call, so there is no Python loop over windows or candles.
+    
+    ARGS:
+        quotes: <numpy array> - (N, 5) quotes of the whole series, see quote_array
+        starts: <numpy array> - the position of every window start
+        window_size: <int> - how many timesteps will a window consist of
+        candle_size: <float> - the size of each candle
+        height: <int> - image height in pixels
+        width: <int> - image width in pixels
+        colorup: <tuple> - RGB of a candle where close >= open
+        colordown: <tuple> - RGB of a candle where close < open
+        chunk_size: <int> - windows drawn per call - bounds the temporary arrays to chunk_size images
+        
+    RETURNS:
+        <numpy array> - (len(starts), height, width, 3) uint8 RGB images
+    """
+    quotes = np.asarray(quotes, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.int64)
+    images = np.empty((len(starts), height, width, 3), dtype=np.uint8)
+    
+    for a in range(0, len(starts), chunk_size):
+        # (chunk, window_size, 5) gathered in one fancy index
+        windows = quotes[starts[a:a + chunk_size, None] + np.arange(window_size)]
+        images[a:a + chunk_size] = rasterize_windows(windows, candle_size, height, width, colorup, colordown)
+        
+    return images
     
     
 # test function
@@ -47,14 +222,8 @@ def candlestick_test(df_, window_size, candle_width=0.015):
         window_size: <int> - the window size. If you select 15 and each timestep is 1hr, then the window size is 15hrs
         candle_width: <float> - width of the candlestick - you may need to play around with this number and 'eye it'
     """
-    # grabbing window size 
-    test_window = df_.iloc[:int(window_size)].copy()
-    
-    # converting dates into floats for ohcl framework
-    test_window['date'] = [mdates.date2num(d) for d in test_window['date']]
-    
-    # re-arranging values for ohlc
-    quotes = [tuple(x) for x in test_window[['date', 'open', 'high', 'low', 'close']].values]
+    # grabbing window size - dates converted into floats for ohcl framework
+    quotes = quote_array(df_.iloc[:int(window_size)])
     
     # plotting
     fig, ax = plt.subplots()
@@ -69,139 +238,293 @@ def candlestick_test(df_, window_size, candle_width=0.015):
     plt.gcf().autofmt_xdate()
     
     
-def save_images_multi(df_, save_path,  buy_percentage, sell_percentage, window_size=15, target_size=3, candle_size=0.022):
+def peak_rss():
     """
-    This function will be our worker function - take a dataframe along with the save_path and other parameters to create a dataset of buy, sell, and hold images. Buys and sells will be labeled above and below thresholds respectively while anything in between will be a hold
+    Returns the peak resident memory of this process in MB - NaN if it cannot be measured on this platform (Windows without psutil).
+    """
+    if resource is not None:
+        # ru_maxrss is in bytes on macOS, in KB on Linux
+        scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        # peak working set on Windows, the current RSS elsewhere
+        return getattr(info, 'peak_wset', info.rss) / (1024 * 1024)
+
+    return float('nan')
+
+
+def new_canvas():
+    """
+    Creates one off-screen figure to draw every window of a worker on. The figure is never registered with pyplot, so nothing is left behind between windows and memory stays flat.
+    
+    RETURNS:
+        fig, ax
+    """
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    
+    # same layout as plt.gcf().autofmt_xdate()
+    fig.subplots_adjust(bottom=0.2)
     
+    return fig, ax
+
+
+def draw_window(canvas, quotes, candle_size=0.022):
+    """
+    Draws one window of quotes on a figure from new_canvas - candlestick_ohlc with colorup='g', colordown='r' and the axis hidden.
+    """
+    fig, ax = canvas
+    
+    # Plot candlestick - on a cleared axes
+    ax.clear()
+    candlestick_ohlc(ax, quotes, width=candle_size, colorup='g', colordown='r')
+
+    # hiding x, y values
+    ax.set_yticks([])
+    ax.set_xticks([])
+    ax.axis('off')
+
+
+def window_image(quotes, candle_size=0.022, renderer='matplotlib', canvas=None):
+    """
+    Renders one window of quotes into an array instead of a file.
     
     ARGS:
-        df_: <pandas dataframe object>
-        save_path: <string> - where we will store all our images
-        window_size: <int> - how many timesteps will a window consist of: if you select 15, and each timestep is 1hr, then the window size will be 15hr
-        target_size: <int> - how far off are we labeling an projecting? If you select 3, then we are labeling on the 18th (if the window size is 15)
+        quotes: <list or numpy array> - (date, open, high, low, close) of every candle in the window
         candle_size: <float> - the size of each candle
-        buy_percentage: <float> - how much of an increase in price from window end to target for the image to be labeled as buy? If you select 0.03 we are only labeling images buy if there was an increase by 3% from the close of the end of the window_size to the open of the target
-        sell_percentage: <float> - same as buy but for sell
+        renderer: <string> - 'matplotlib' plots with candlestick_ohlc, 'raster' draws with render_candles
+        canvas: <tuple> - (fig, ax) from new_canvas to draw on, a new one is created if None
+        
+    RETURNS:
+        <numpy array> - (480, 640, 3) uint8 RGB image
     """
-    gc.disable()
+    if renderer == 'raster':
+        return render_candles(quotes, candle_size=candle_size)
     
-    # instantiating 
-    start_index = 0
-    end_index = window_size   # size of the window
-    label_index = window_size + target_size # our target
+    canvas = canvas if canvas is not None else new_canvas()
+    draw_window(canvas, quotes, candle_size)
     
-    # checking if this is the first batch
-    if df_.index.min() == 0:
-        img_index = 0
+    fig = canvas[0]
+    fig.canvas.draw()
     
-    else:
-        # grabbing the starting index of the dataframe
-        img_index = df_.index.min() + 1 
+    return np.asarray(fig.canvas.buffer_rgba())[..., :3].copy()
+
+
+def save_window(quotes, file, candle_size=0.022, renderer='matplotlib', canvas=None):
+    """
+    Plots one window of quotes and saves it as an image.
+    
+    ARGS:
+        quotes: <list or numpy array> - (date, open, high, low, close) of every candle in the window
+        file: <string> - where the image is saved
+        candle_size: <float> - the size of each candle
+        renderer: <string> - 'matplotlib' plots with candlestick_ohlc, 'raster' draws with render_candles
+        canvas: <tuple> - (fig, ax) from new_canvas to draw on, a new one is created if None
+    """
+    if renderer == 'raster':
+        plt.imsave(file, render_candles(quotes, candle_size=candle_size))
+        return
     
-    for i in tqdm(range(len(df_))):
+    canvas = canvas if canvas is not None else new_canvas()
+    draw_window(canvas, quotes, candle_size)
+    
+    canvas[0].savefig(file, dpi=100)
+    
+    
+def label_windows(open_, close, window_size=15, target_size=3, buy_percentage=0.001, sell_percentage=0.001, binary=False):
+    """
+    This function labels every window of a series in one pass - the same Buy / Sell / Hold rule as the image workers, without touching a single image. A window starting at row s closes at s + window_size - 1 and is labeled on the open of row s + window_size + target_size:
+        Buy - the target open is at least buy_percentage above the window close
+        Sell - the target open is at least sell_percentage below the window close
+        Hold - anything in between (dropped if binary)
+    
+    Labeling is cheap, so class balance can be checked (np.bincount(labels)) and windows filtered before paying for any rendering.
+    
+    ARGS:
+        open_: <numpy array> - open of every row
+        close: <numpy array> - close of every row
+        window_size: <int> - how many timesteps will a window consist of
+        target_size: <int> - how far off are we labeling an projecting
+        buy_percentage: <float> - see save_images_multi
+        sell_percentage: <float> - see save_images_multi
+        binary: <boolean> - if True, holds are discarded (save_images_binary)
         
-        try:
-
-            # Creating our window
-            window_df = df_.iloc[start_index:end_index]
-            
-            # grabbing close 
-            day_close = window_df.iloc[-1]['close']
-            
-            # Calculating % increase
-            buy_percent_increase = day_close + (day_close * buy_percentage)
-            
-            # Calculating % decrease
-            sell_percent_decrease = day_close - (day_close * sell_percentage)
-            
-            # Converting window_df into quotes for OHCL
-            quotes = [tuple(x) for x in window_df[['date','open','high','low','close']].values]
-            
-            # Plot candlestick.
-            fig, ax = plt.subplots()
-            candlestick_ohlc(ax, quotes, width=candle_size, colorup='g', colordown='r')
+    RETURNS:
+        starts, labels - the row every labeled window starts at, and its label as a code into omega_shards.LABELS
+    """
+    open_ = np.asarray(open_, dtype=np.float64)
+    close = np.asarray(close, dtype=np.float64)
+    
+    # every window that has a target
+    starts = np.arange(max(len(open_) - window_size - target_size, 0))
+    day_close = close[starts + window_size - 1]
+    target_open = open_[starts + window_size + target_size]
+    
+    # same thresholds as the workers always used
+    buy = target_open >= day_close + (day_close * buy_percentage)
+    sell = ~buy & (target_open <= day_close - (day_close * sell_percentage))
+    
+    labels = np.full(len(starts), LABELS.index('Hold'), dtype=np.uint8)
+    labels[buy] = LABELS.index('Buy')
+    labels[sell] = LABELS.index('Sell')
+    
+    if binary:
+        keep = buy | sell
+        starts, labels = starts[keep], labels[keep]
+        
+    return starts, labels
 
-            # hiding x, y values
-            plt.yticks([])
-            plt.xticks([])
-            plt.axis('off')
 
-            plt.gcf().autofmt_xdate()
+class WindowSaver:
+    """
+    Writes rendered windows to one of the outputs of save_images_multi - PNG files, npy shards or label metadata over a render cache. One saver per dataset directory: save_windows uses one, save_images_sizes one per window size.
+    
+    ARGS:
+        save_path: <string> - where we will store all our images
+        row_index: <numpy array> - the global row of every position in the dataframe, images are named by it
+        candle_size: <float> - the size of each candle
+        renderer: <string> - 'matplotlib' or 'raster', see save_window
+        output: <string> - 'png', 'npy' or 'cache', see save_images_multi
+        shard_size: <int> - windows per shard when output is 'npy', None fits omega_shards.SHARD_BYTES of images
+        cache: <RenderCache> - render cache to look windows up in, None renders every window
+        canvas: <tuple> - (fig, ax) from new_canvas to draw on
+    """
+    def __init__(self, save_path, row_index, candle_size=0.022, renderer='matplotlib', output='png', shard_size=None, cache=None, canvas=None):
+        if output == 'cache' and cache is None:
+            raise ValueError("output='cache' needs a cache_path")
+        
+        self.save_path = save_path
+        self.row_index = row_index
+        self.candle_size = candle_size
+        self.renderer = renderer
+        self.output = output
+        self.cache = cache
+        self.canvas = canvas
+        
+        # every worker writes its own shards, named by its first row
+        self.writer = ShardWriter(save_path, prefix=f'shard_{row_index[0]:09d}', shard_size=shard_size) if output == 'npy' and len(row_index) else None
+        
+        # labels and keys of output='cache'
+        self.rows, self.labels, self.keys = [], [], []
+        
+    def save(self, quotes, start, label):
+        """
+        Renders (or looks up) one window and writes it.
+        
+        ARGS:
+            quotes: <list or numpy array> - (date, open, high, low, close) of every candle in the window
+            start: <int> - position of the window start in the dataframe
+            label: <int> - code into omega_shards.LABELS
+        """
+        row = self.row_index[start]
+        file = f'{self.save_path}/{row}.{LABELS[label]}.png'
+        
+        # Plot candlestick and save
+        if self.cache is None and self.writer is None:
+            save_window(quotes, file, self.candle_size, self.renderer, self.canvas)
+            return
+        
+        # rendering only what the cache does not have
+        image = None
+        if self.cache is not None:
+            key = window_key(quotes, self.candle_size, self.renderer)
+            image = self.cache.get(key)
             
-            # Labelling 
+        if image is None:
+            image = window_image(quotes, self.candle_size, self.renderer, self.canvas)
+            if self.cache is not None:
+                self.cache.put(key, image, row)
+        
+        if self.writer is not None:
+            self.writer.write(image, label, row)
+        elif self.output == 'cache':
+            self.rows.append(row)
+            self.labels.append(label)
+            self.keys.append(key)
+        else:
+            plt.imsave(file, image)
             
-            # BUY
-            if df_.iloc[label_index]['open'] >= buy_percent_increase:
-                
-                # Saving buy
-                label = 'Buy'
-                plt.savefig(f'{path}/{img_index}.{label}.png', dpi=100)
-                
-                # Clearing memory
-                plt.close('all')
-                plt.clf()
-                plt.cla()
-                fig.clf()
-
-                # Increase image index
-                img_index += 1
+    def close(self):
+        """
+        Flushes the last partial shard, or writes the labels and keys of output='cache' - the pixels stay in the cache.
+        """
+        if self.writer is not None:
+            self.writer.close()
             
-            # SELL
-            elif df_.iloc[label_index]['open'] <= sell_percent_decrease:
-                
-                # Sell
-                label = 'Sell'
-                plt.savefig(f'{path}/{img_index}.{label}.png', dpi=100)
-                
-                # Clearing memory
-                plt.close('all')
-                plt.clf()
-                plt.cla()
-                fig.clf()
-
-                # Increase image index
-                img_index += 1
-                
-            # HOLD
-            else:
-                
-                # Hold
-                label = 'Hold'
-                plt.savefig(f'{path}/{img_index}.{label}.png', dpi=100)
-                
-                
-                # Clearing memory
-                plt.close('all')
-                plt.clf()
-                plt.cla()
-                fig.clf()
-
-                # Increase index
-                img_index += 1
-                
-            # Coutning up index
-            start_index += 1
-            end_index += 1
-            label_index += 1
+        if self.output == 'cache' and len(self.row_index):
+            save_keys(self.save_path, f'labels_{self.row_index[0]:09d}', self.labels, self.rows, self.keys)
             
-            if i % 1000 == 0:
-                sleep(5)
-                gc.collect()
-                sleep(5)
 
+def save_windows(df_, save_path, starts, labels, window_size=15, candle_size=0.022, renderer='matplotlib', output='png', shard_size=None, cache_path=None):
+    """
+    Renders the selected windows of a dataframe - the rendering half of save_images_multi / save_images_binary. Only the windows in starts are drawn.
+    
+    With a cache_path, every window is looked up in a RenderCache by its content (window_key) first and only rendered on a miss - the same windows labeled with another buy / sell threshold are never rendered twice. output='cache' then writes nothing but the labels and keys of the windows ({save_path}/labels_{first_row}.npz, read back with omega_shards.open_cached), so a new label set takes seconds.
+    
+    ARGS:
+        df_: <pandas dataframe object> - date, open, high, low, close - date as float (mdates.date2num)
+        save_path: <string> - where we will store all our images
+        starts: <numpy array> - the position in df_ of every window to render
+        labels: <numpy array> - the label of every window, a code into omega_shards.LABELS
+        window_size: <int> - how many timesteps will a window consist of
+        candle_size: <float> - the size of each candle
+        renderer: <string> - 'matplotlib' or 'raster', see save_window
+        output: <string> - 'png', 'npy' or 'cache', see save_images_multi
+        shard_size: <int> - windows per shard when output is 'npy', None fits omega_shards.SHARD_BYTES of images
+        cache_path: <string> - directory of the render cache, None renders every window
+    """
+    # one figure for every window
+    canvas = new_canvas() if renderer == 'matplotlib' else None
+    
+    cache = RenderCache(cache_path, shard_size=shard_size) if cache_path is not None else None
+    saver = WindowSaver(save_path, df_.index.values, candle_size, renderer, output, shard_size, cache, canvas)
+    
+    # quotes of the whole dataframe - every window is a view on it
+    quotes = quote_array(df_)
+    
+    for start, label in tqdm(zip(starts, labels), total=len(starts)):
+        saver.save(quotes[start:start + window_size], start, label)
             
-        except Exception:
-            pass
-        
-        
+    saver.close()
+    if cache is not None:
+        cache.close()
+    
     # finished
-    print('Finished')
+    print(f'Finished - peak RSS: {peak_rss():.0f} MB')
+    
+    
+def save_images_multi(df_, save_path,  buy_percentage, sell_percentage, window_size=15, target_size=3, candle_size=0.022, renderer='matplotlib', output='png', shard_size=None, cache_path=None):
+    """
+    This function will be our worker function - take a dataframe along with the save_path and other parameters to create a dataset of buy, sell, and hold images. Buys and sells will be labeled above and below thresholds respectively while anything in between will be a hold
     
+    Every window is labeled up front with label_windows, then rendered with save_windows.
     
-def save_images_binary(df_, save_path,  buy_percentage, sell_percentage, window_size=15, target_size=3, candle_size=0.022):
+    ARGS:
+        df_: <pandas dataframe object>
+        save_path: <string> - where we will store all our images
+        window_size: <int> - how many timesteps will a window consist of: if you select 15, and each timestep is 1hr, then the window size will be 15hr
+        target_size: <int> - how far off are we labeling an projecting? If you select 3, then we are labeling on the 18th (if the window size is 15)
+        candle_size: <float> - the size of each candle
+        buy_percentage: <float> - how much of an increase in price from window end to target for the image to be labeled as buy? If you select 0.03 we are only labeling images buy if there was an increase by 3% from the close of the end of the window_size to the open of the target
+        sell_percentage: <float> - same as buy but for sell
+        renderer: <string> - 'matplotlib' plots every window with candlestick_ohlc, 'raster' draws it straight into an array with render_candles (much faster)
+        output: <string> - 'png' writes one {row}.{label}.png per window, 'npy' packs the windows into memory-mappable shards in save_path (see omega_shards), 'cache' only writes labels and keys into save_path and keeps the pixels in the render cache
+        shard_size: <int> - windows per shard when output is 'npy', None fits omega_shards.SHARD_BYTES of images
+        cache_path: <string> - directory of a render cache shared by every label configuration, see save_windows
+    """
+    starts, labels = label_windows(df_['open'].values, df_['close'].values, window_size, target_size, buy_percentage, sell_percentage)
+    
+    save_windows(df_, save_path, starts, labels, window_size, candle_size, renderer, output, shard_size, cache_path)
+    
+    
+def save_images_binary(df_, save_path,  buy_percentage, sell_percentage, window_size=15, target_size=3, candle_size=0.022, renderer='matplotlib', output='png', shard_size=None, cache_path=None):
     """
     This function will be our worker function - take a dataframe along with the save_path and other parameters to create a dataset of buy and sell only. That is, everything above the buy threshold will be a buy and everything below the sell threshold will be a sell anything in between will be discarded.
     
+    Holds are dropped by label_windows before anything is rendered.
     
     ARGS:
         df_: <pandas dataframe object>
@@ -211,105 +534,143 @@ def save_images_binary(df_, save_path,  buy_percentage, sell_percentage, window_
         candle_size: <float> - the size of each candle
         buy_percentage: <float> - how much of an increase in price from window end to target for the image to be labeled as buy? If you select 0.03 we are only labeling images buy if there was an increase by 3% from the close of the end of the window_size to the open of the target
         sell_percentage: <float> - same as buy but for sell
+        renderer: <string> - 'matplotlib' plots every window with candlestick_ohlc, 'raster' draws it straight into an array with render_candles (much faster)
+        output: <string> - 'png', 'npy' or 'cache', see save_images_multi
+        shard_size: <int> - windows per shard when output is 'npy', None fits omega_shards.SHARD_BYTES of images
+        cache_path: <string> - directory of the render cache, see save_windows
     """
-    gc.disable()
+    starts, labels = label_windows(df_['open'].values, df_['close'].values, window_size, target_size, buy_percentage, sell_percentage, binary=True)
     
-    # instantiating 
-    start_index = 0
-    end_index = window_size   # size of the window
-    label_index = window_size + target_size # our target
+    save_windows(df_, save_path, starts, labels, window_size, candle_size, renderer, output, shard_size, cache_path)
     
-    # checking if this is the first batch
-    if df_.index.min() == 0:
-        img_index = 0
     
-    else:
-        # grabbing the starting index of the dataframe
-        img_index = df_.index.min() + 1 
+def save_images_sizes(df_, save_path, buy_percentage, sell_percentage, window_sizes=(3, 6, 12, 24, 48), target_size=3, candle_size=0.022, binary=False, renderer='matplotlib', output='png', shard_size=None, cache_path=None, first_end=0):
+    """
+    This is the worker for building the datasets of several window sizes (the W3 ... W48 models) at once. Instead of one save_images_multi call - and one walk over the dataframe - per window size, the series is scanned once: at every bar, the window of every size ending on that bar is rendered into {save_path}/W{window_size}.
+    
+    The quotes array is built once and every window of every size is a view on it. Labels come from label_windows, one vectorized pass per size. A single render cache (the key includes the window size) and figure are shared by every size.
+    
+    ARGS:
+        df_: <pandas dataframe object> - date, open, high, low, close - date as float (mdates.date2num)
+        save_path: <string> - root directory, every size gets its own W{window_size} directory
+        buy_percentage: <float> - see save_images_multi
+        sell_percentage: <float> - see save_images_multi
+        window_sizes: <list> - the window sizes to render
+        target_size: <int> - how far off are we labeling an projecting
+        candle_size: <float> - the size of each candle
+        binary: <boolean> - if True, holds are discarded (save_images_binary)
+        renderer: <string> - 'matplotlib' or 'raster', see save_window
+        output: <string> - 'png', 'npy' or 'cache', see save_images_multi
+        shard_size: <int> - windows per shard when output is 'npy', None fits omega_shards.SHARD_BYTES of images
+        cache_path: <string> - directory of the render cache, see save_windows
+        first_end: <int> - only windows ending at or after this position are rendered - generate_images uses it so overlapping shards never render a window twice
+    """
+    # one quotes array for every size
+    quotes = quote_array(df_)
+    row_index = df_.index.values
+    
+    # one figure and one cache for every size
+    canvas = new_canvas() if renderer == 'matplotlib' else None
+    cache = RenderCache(cache_path, shard_size=shard_size) if cache_path is not None else None
     
-    for i in tqdm(range(len(df_))):
+    savers, ends, sizes, labels = [], [], [], []
+    for k, window_size in enumerate(window_sizes):
+        size_path = f'{save_path}/W{window_size}'
+        os.makedirs(size_path, exist_ok=True)
+        savers.append(WindowSaver(size_path, row_index, candle_size, renderer, output, shard_size, cache, canvas))
         
-        try:
-
-            # Creating our window
-            window_df = df_.iloc[start_index:end_index]
-            
-            # grabbing close 
-            day_close = window_df.iloc[-1]['close']
-            
-            # Calculating % increase
-            buy_percent_increase = day_close + (day_close * buy_percentage)
-            
-            # Calculating % decrease
-            sell_percent_decrease = day_close - (day_close * sell_percentage)
-            
-            # Converting window_df into quotes for OHCL
-            quotes = [tuple(x) for x in window_df[['date','open','high','low','close']].values]
-            
-            # Plot candlestick.
-            fig, ax = plt.subplots()
-            candlestick_ohlc(ax, quotes, width=candle_size, colorup='g', colordown='r')
-
-            # hiding x, y values
-            plt.yticks([])
-            plt.xticks([])
-            plt.axis('off')
-
-            plt.gcf().autofmt_xdate()
-            
-            # Labelling 
-            
-            # BUY
-            if df_.iloc[label_index]['open'] >= buy_percent_increase:
-                
-                # Saving buy
-                label = 'Buy'
-                plt.savefig(f'{path}/{img_index}.{label}.png', dpi=100)
-                
-                # Clearing memory
-                plt.close('all')
-                plt.clf()
-                plt.cla()
-                fig.clf()
-
-                # Increase image index
-                img_index += 1
-            
-            # SELL
-            elif df_.iloc[label_index]['open'] <= sell_percent_decrease:
-                
-                # Sell
-                label = 'Sell'
-                plt.savefig(f'{path}/{img_index}.{label}.png', dpi=100)
-                
-                # Clearing memory
-                plt.close('all')
-                plt.clf()
-                plt.cla()
-                fig.clf()
-
-                # Increase image index
-                img_index += 1
-                
-            # HOLD
-            else:
-                
-                pass
-                
-            # Coutning up index
-            start_index += 1
-            end_index += 1
-            label_index += 1
-            
-            if i % 1000 == 0:
-                sleep(5)
-                gc.collect()
-                sleep(5)
-
-            
-        except Exception:
-            pass
+        # labeling every window of this size, keeping the ones this worker owns
+        starts, size_labels = label_windows(quotes[:, 1], quotes[:, 4], window_size, target_size, buy_percentage, sell_percentage, binary=binary)
+        end = starts + window_size - 1
+        keep = end >= first_end
+        
+        ends.append(end[keep])
+        sizes.append(np.full(keep.sum(), k))
+        labels.append(size_labels[keep])
         
+    # one scan over the bars - every size ending on a bar, in order
+    ends, sizes, labels = np.concatenate(ends), np.concatenate(sizes), np.concatenate(labels)
+    order = np.lexsort((sizes, ends))
+    
+    for end, k, label in tqdm(zip(ends[order], sizes[order], labels[order]), total=len(order)):
+        start = end - window_sizes[k] + 1
+        savers[k].save(quotes[start:end + 1], start, label)
+        
+    for saver in savers:
+        saver.close()
+    if cache is not None:
+        cache.close()
         
     # finished
-    print('Finished')
\ No newline at end of file
+    print(f'Finished - peak RSS: {peak_rss():.0f} MB')
+    
+    
+def shard_windows(n, window_size, target_size, shards):
+    """
+    Splits the windows of a series of n rows into shards. Every shard gets a contiguous range of window starts, and its rows overlap the next shard by window_size + target_size so the windows at the seams have both their candles and their target.
+    
+    ARGS:
+        n: <int> - number of rows in the series
+        window_size: <int> - how many timesteps will a window consist of
+        target_size: <int> - how far off are we labeling
+        shards: <int> - how many shards
+        
+    RETURNS:
+        <list> - (first_row, last_row) of every shard, last_row excluded
+    """
+    # a window starting at s needs rows s ... s + window_size + target_size
+    windows = max(n - window_size - target_size, 0)
+    bounds = np.linspace(0, windows, shards + 1).astype(int)
+    
+    return [(a, b + window_size + target_size) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def generate_images(df_, save_path, buy_percentage, sell_percentage, window_size=15, target_size=3, candle_size=0.022, binary=False, renderer='raster', output='png', shard_size=None, cache_path=None, processes=None, shards=None):
+    """
+    This function replaces splitting the dataframe with batch_split_two and running a worker on every half by hand. The series is split into overlapping shards with shard_windows and every shard runs save_images_multi (or save_images_binary) on a process pool.
+    
+    Images are named by the global row of their window start, so every window is rendered exactly once whatever the number of shards: {row}.{label}.png - or, with output='npy', every shard packs its windows into npy shards read back with omega_shards.open_shards / iter_shards.
+    
+    A list of window sizes builds every size in one pass with save_images_sizes, into {save_path}/W{window_size}.
+    
+    ARGS:
+        df_: <pandas dataframe object> - date, open, high, low, close - date as datetime or float (mdates.date2num)
+        save_path: <string> - where we will store all our images
+        buy_percentage: <float> - see save_images_multi
+        sell_percentage: <float> - see save_images_multi
+        window_size: <int or list> - how many timesteps will a window consist of, or a list of window sizes
+        target_size: <int> - how far off are we labeling an projecting
+        candle_size: <float> - the size of each candle
+        binary: <boolean> - if True, holds are discarded (save_images_binary)
+        renderer: <string> - 'matplotlib' or 'raster', see save_window
+        output: <string> - 'png', 'npy' or 'cache', see save_images_multi
+        shard_size: <int> - windows per npy shard, None fits omega_shards.SHARD_BYTES of images
+        cache_path: <string> - directory of the render cache, see save_windows
+        processes: <int> - number of worker processes, defaults to the number of cores
+        shards: <int> - number of shards, defaults to the number of processes
+    """
+    processes = processes or mp.cpu_count()
+    shards = shards or processes
+    
+    # global row numbers, and float dates for ohlc
+    df = df_.reset_index(drop=True)
+    if not np.issubdtype(df['date'].dtype, np.number):
+        df = df.assign(date=mdates.date2num(df['date'].values))
+    
+    if np.ndim(window_size):
+        # sharded by the largest size - a shard owns the windows ending in its range, the first shard every window
+        largest = max(window_size)
+        worker = save_images_sizes
+        jobs = [
+            (df.iloc[a:b], save_path, buy_percentage, sell_percentage, list(window_size), target_size, candle_size, binary, renderer, output, shard_size, cache_path, 0 if a == 0 else largest - 1)
+            for a, b in shard_windows(len(df), largest, target_size, shards)
+        ]
+    else:
+        worker = save_images_binary if binary else save_images_multi
+        jobs = [
+            (df.iloc[a:b], save_path, buy_percentage, sell_percentage, window_size, target_size, candle_size, renderer, output, shard_size, cache_path)
+            for a, b in shard_windows(len(df), window_size, target_size, shards)
+        ]
+    
+    with mp.Pool(processes) as pool:
+        pool.starmap(worker, jobs)
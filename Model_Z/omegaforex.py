@@ -3,20 +3,94 @@ import sys
 import json
 import os
 import time
+import glob
+import threading
+import requests
+import pandas as pd
 
 from datetime import date
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from oandapyV20.contrib.factories import InstrumentsCandlesFactory
 from oandapyV20 import API
+from oandapyV20.exceptions import V20Error
+from oandapyV20.oandapyV20 import TRADING_ENVIRONMENTS
+
+from omega_candles import CandleWriter
 
 # instantiating API Acess
 access_token = "75e433aae2d86eb803457a23008a4cd5-4e2eddaf539b5f55b612cea9cb36e4f6" # change this
 client = API(access_token=access_token)
 
+# one API client (requests session) per download thread
+thread_clients = threading.local()
+
+
+def use_api_url(api_url, environment='local'):
+    """
+    Points client (and every download thread) at another REST endpoint, example: a local stub server standing in for Oanda.
+    
+    ARGS:
+        api_url: <string> - example: "http://127.0.0.1:8000"
+        environment: <string> - name the endpoint is registered under
+    """
+    global client
+    
+    TRADING_ENVIRONMENTS[environment] = {'api': api_url, 'stream': api_url}
+    client = API(access_token=access_token, environment=environment)
+    
+    return client
+
+
+def thread_client():
+    """
+    Returns the API client of the current thread - a copy of client's settings, since a requests session should not be shared between threads.
+    """
+    api = getattr(thread_clients, 'api', None)
+    
+    if api is None or api.environment != client.environment or api.access_token != client.access_token:
+        api = API(access_token=client.access_token, environment=client.environment, request_params=client.request_params)
+        thread_clients.api = api
+        
+    return api
+
+
+class RateLimiter:
+    """
+    Spaces requests at least 1 / rate seconds apart across every download thread. A rate limit response pushes every thread back.
+    
+    ARGS:
+        rate: <float> - max requests per second, None means no limit
+    """
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+        
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+            
+        if slot > now:
+            time.sleep(slot - now)
+            
+    def pause(self, seconds):
+        with self.lock:
+            self.next_time = max(self.next_time, time.monotonic() + seconds)
+
 # Pulling Functions
-def cnv(r, h):
+def cnv(r, h, after=None):
+    last = after
     for candle in r.get('candles'):
         ctime = candle.get('time')[0:19]
+        
+        # skipping candles we already have
+        if after is not None and ctime <= after:
+            continue
+        
         try:
             rec = "{time},{complete},{o},{h},{l},{c},{v}".format(
                 time=ctime,
@@ -31,18 +105,177 @@ def cnv(r, h):
             print(e, r)
         else:
             h.write(rec+"\n")
+            last = ctime
+            
+    return last
 
-def download_data(start_date, end_date, gr, instr, path):
+def last_complete_candle(file, block_size=1 << 16):
+    """
+    This will find the last complete candle of a CSV written by download_data, reading the file backwards from the end so only the last few KB are touched.
+    
+    ARGS:
+        file: <string> - path to the CSV
+        block_size: <int> - how many bytes are read at a time
+        
+    RETURNS:
+        time, offset
+        
+        time: <string> - time of the last complete candle, example: '2018-01-01T21:00:00' (None if there is none)
+        offset: <int> - byte offset right after that candle's line - anything after it is incomplete and will be replaced
+    """
+    with open(file, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        tail = b''
+        
+        while pos > 0:
+            
+            # reading one more block backwards
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            tail = f.read(step) + tail
+            
+            # the first line may be cut in the middle unless we reached the start of the file
+            start = 0 if pos == 0 else tail.find(b'\n') + 1
+            if start == 0 and pos > 0:
+                continue
+            
+            # walking back over whole lines - a last line without a newline was never finished
+            idx = tail.rfind(b'\n')
+            while idx >= start:
+                line_start = max(tail.rfind(b'\n', start, idx) + 1, start)
+                fields = tail[line_start:idx].split(b',')
+                
+                if len(fields) == 7 and fields[1] == b'True':
+                    return fields[0].decode(), pos + idx + 1
+                
+                idx = line_start - 1
+                
+    return None, 0
+
+
+def fetch_candles(r, limiter, max_retries=5, backoff=1.0):
+    """
+    Runs one candle request with retries. Rate limit (429), server errors (5xx) and connection errors are retried with an exponential backoff, anything else is raised right away.
+    
+    ARGS:
+        r: <InstrumentsCandles> - a request from InstrumentsCandlesFactory
+        limiter: <RateLimiter> - shared by every download thread
+        max_retries: <int> - how many times a request is retried
+        backoff: <float> - seconds to wait before the first retry, doubled every retry
+        
+    RETURNS:
+        the response of the request
+    """
+    for attempt in range(max_retries + 1):
+        limiter.wait()
+        delay = backoff * (2 ** attempt)
+        
+        try:
+            thread_client().request(r)
+            return r.response
+        
+        except V20Error as e:
+            if (e.code != 429 and e.code < 500) or attempt == max_retries:
+                raise
+            
+            # slowing every thread down, not just this one
+            if e.code == 429:
+                limiter.pause(delay)
+                
+            print(f'RETRY {attempt + 1}/{max_retries} in {delay}s: {r.params} [{e.code}]')
+            
+        except requests.RequestException as e:
+            if attempt == max_retries:
+                raise
+            
+            print(f'RETRY {attempt + 1}/{max_retries} in {delay}s: {r.params} [{e}]')
+            
+        time.sleep(delay)
+
+
+def write_candles(response, O, after, stats=None):
+    """
+    Writes one response with cnv (or to a CandleWriter) and updates the request/candle counts of stats. Returns the time of the last candle written.
+    """
+    if stats is not None:
+        stats['requests'] += 1
+        stats['candles'] += len(response.get('candles'))
+        
+    # binary candle stores write typed columns instead of CSV lines
+    if isinstance(O, CandleWriter):
+        return O.write_candles(response, after=after)
+        
+    return cnv(response, O, after=after)
+
+
+def request_candles(instr, params, O, after=None, workers=4, rate=100, max_retries=5, backoff=1.0, pool=None, limiter=None, stats=None, verbose=True):
+    """
+    Requests every candle of params through InstrumentsCandlesFactory and writes them to the open file O with cnv.
+    
+    The factory's chunk requests run on a pool of worker threads, at most 2 * workers in flight. Responses are written in request order, so the file stays in time order. Candles at or before the last written one (chunk boundaries) are skipped.
+    
+    ARGS:
+        instr: <string> - instrument or 'pair' - example: "GBP_USD"
+        params: <dict> - granularity, from and to of the request
+        O: <file object or CandleWriter> - where the candles are written
+        after: <string> - only candles after this time are written
+        workers: <int> - number of download threads (and half the requests kept in flight)
+        rate: <float> - max requests per second over all threads
+        max_retries: <int> - how many times a failed request is retried
+        backoff: <float> - seconds to wait before the first retry, doubled every retry
+        pool: <ThreadPoolExecutor> - shared pool to run the requests on, a new one of size workers if None
+        limiter: <RateLimiter> - shared request budget, a new one of rate if None
+        stats: <dict> - if given, its 'requests' and 'candles' counts are increased as responses are written
+        verbose: <boolean> - if True, every request is printed
+    """
+    limiter = limiter if limiter is not None else RateLimiter(rate)
+    own_pool = pool is None
+    pool = ThreadPoolExecutor(max_workers=workers) if own_pool else pool
+    pending = deque()
+    
+    try:
+        for r in InstrumentsCandlesFactory(instrument=instr, params=params):
+            if verbose:
+                print("REQUEST: {} {} {}".format(r, r.__class__.__name__, r.params))
+            pending.append(pool.submit(fetch_candles, r, limiter, max_retries, backoff))
+            
+            # writing the oldest response once enough are in flight
+            if len(pending) >= 2 * workers:
+                after = write_candles(pending.popleft().result(), O, after, stats)
+                
+        while pending:
+            after = write_candles(pending.popleft().result(), O, after, stats)
+            
+    except Exception:
+        # no point downloading the rest of a file we cannot finish
+        for future in pending:
+            future.cancel()
+        raise
+        
+    finally:
+        if own_pool:
+            pool.shutdown(wait=True)
+
+
+def download_data(start_date, end_date, gr, instr, path, incremental=False, storage='csv', **kwargs):
     """
     
     This will download raw price action data from OandaAPI and will save it to the path provided in CSV format. 
     
+    With storage='npy' the candles are saved as a binary candle store instead (see omega_candles): a directory of typed .npy columns, loaded with omega_candles.load_candles.
+    
+    With incremental=True, an earlier download of the same instrument, granularity and start_date in path is resumed instead: only candles after its last complete candle are requested. They are downloaded to a temporary file first and appended in one go, then the file is renamed to the new end_date. Incomplete candles at the end of the old file are replaced.
+    
     ARGS:
         start_date: <datetime object> - example: date(2009, 6, 1)
         end_date: <datetime object>
         gr: <string> - granularity of the data (time intervals). Check readme
         instr: <string> - instrument or 'pair' - example: "GBP_USD"
         path: <string> - path to save the CSV
+        incremental: <boolean> - if True, resume from the last stored candle (CSV only)
+        storage: <string> - 'csv' or 'npy'
+        kwargs: passed on to request_candles - workers, rate, max_retries, backoff, pool, limiter, stats, verbose
     """
     _from = f'{start_date.isoformat()}T00:00:00Z'
     _to = f'{end_date.isoformat()}T00:00:00Z'
@@ -55,12 +288,156 @@ def download_data(start_date, end_date, gr, instr, path):
         "to": _to
     }
     
+    if storage not in ('csv', 'npy'):
+        raise ValueError(f"storage must be 'csv' or 'npy', got: {storage}")
+    
+    if incremental and storage != 'csv':
+        raise ValueError('incremental downloads are only supported with CSV storage')
+    
+    file = f'{path}/{instr}_{gran}_{start_date.isoformat()}_{end_date.isoformat()}.csv'
+    
+    # looking for an earlier download to resume - the latest end date up to end_date wins
+    existing = sorted(glob.glob(f'{path}/{instr}_{gran}_{start_date.isoformat()}_*.csv')) if incremental else []
+    existing = [e for e in existing if e[-14:-4] <= end_date.isoformat()]
+    
+    if existing:
+        return append_data(existing[-1], file, params, instr_, **kwargs)
+    
     print(f'Saving to path: {path}')
     
-    with open(f'{path}/{instr}_{gran}_{start_date.isoformat()}_{end_date.isoformat()}.csv', "w") as O:
-        for r in InstrumentsCandlesFactory(instrument=instr_, params=params):
-            print("REQUEST: {} {} {}".format(r, r.__class__.__name__, r.params))
-            rv = client.request(r)
-            cnv(r.response, O)
+    if storage == 'npy':
+        with CandleWriter(os.path.splitext(file)[0]) as O:
+            request_candles(instr_, params, O, **kwargs)
+            
+    else:
+        with open(file, "w") as O:
+            request_candles(instr_, params, O, **kwargs)
+            
+    print('Finished')
+
+
+def append_data(old_file, file, params, instr, **kwargs):
+    """
+    Appends the candles after the last complete candle of old_file and renames it to file. Used by download_data(incremental=True).
+    
+    ARGS:
+        old_file: <string> - the CSV to resume
+        file: <string> - the CSV name for the new end date
+        params: <dict> - request params of the full range
+        instr: <string> - instrument or 'pair' - example: "GBP_USD"
+        kwargs: passed on to request_candles
+    """
+    last, offset = last_complete_candle(old_file)
+    
+    if last is not None:
+        
+        # nothing new to request
+        if f'{last}Z' >= params['to']:
+            print(f'Up to date: {old_file}')
+            if old_file != file:
+                os.replace(old_file, file)
+            return
+        
+        params = dict(params, **{"from": f'{last}Z'})
+    
+    print(f'Resuming {old_file} from: {params["from"]}')
+    
+    # downloading everything new before touching the stored file
+    tmp_file = f'{file}.tmp'
+    with open(tmp_file, "w") as O:
+        request_candles(instr, params, O, after=last, **kwargs)
+    
+    try:
+        with open(old_file, "r+b") as O, open(tmp_file, "rb") as new:
+            
+            # dropping incomplete candles and appending
+            O.truncate(offset)
+            O.seek(offset)
+            O.write(new.read())
+            O.flush()
+            os.fsync(O.fileno())
+            
+    except Exception:
+        # rolling back to the last complete candle - never leave a half appended file
+        with open(old_file, "r+b") as O:
+            O.truncate(offset)
+        raise
+        
+    finally:
+        os.remove(tmp_file)
+    
+    if old_file != file:
+        os.replace(old_file, file)
+    
+    print(f'Appended {os.path.getsize(file) - offset} bytes to: {file}')
+    print('Finished')
+
+
+
+def download_bulk(jobs, path, incremental=False, storage='csv', workers=8, rate=100, max_jobs=4, max_retries=5, backoff=1.0):
+    """
+    This will download many instruments and granularities with download_data, all sharing one pool of download threads and one request budget - instead of looping over download_data in a notebook.
+    
+    Up to max_jobs jobs run at once, their chunk requests all go through the same workers threads and together never exceed rate requests per second. Progress is printed as jobs finish, and the requests, candles and throughput of every job are returned.
+    
+    ARGS:
+        jobs: <list> - (instrument, granularity, start_date, end_date) tuples, example: [("GBP_USD", "H1", date(2016, 1, 1), date(2018, 1, 1))]
+        path: <string> - path to save the CSVs
+        incremental: <boolean> - if True, every job resumes from its last stored candle
+        storage: <string> - 'csv' or 'npy', see download_data
+        workers: <int> - number of download threads shared by every job
+        rate: <float> - max requests per second over every job
+        max_jobs: <int> - how many jobs are downloaded at once
+        max_retries: <int> - how many times a failed request is retried
+        backoff: <float> - seconds to wait before the first retry, doubled every retry
+        
+    RETURNS:
+        <pandas.DataFrame> one row per job: instrument, granularity, start_date, end_date, requests, candles, seconds, candles_per_sec, error
+    """
+    limiter = RateLimiter(rate)
+    results = []
+    lock = threading.Lock()
+    started = time.monotonic()
+    
+    def run(job):
+        instr, gr, start_date, end_date = job
+        stats = {'requests': 0, 'candles': 0}
+        error = None
+        job_start = time.monotonic()
+        
+        try:
+            download_data(start_date, end_date, gr, instr, path, incremental=incremental, storage=storage,
+                          workers=workers, pool=pool, limiter=limiter, stats=stats,
+                          max_retries=max_retries, backoff=backoff, verbose=False)
+        except Exception as e:
+            error = repr(e)
             
-    print('Finished')
\ No newline at end of file
+        seconds = time.monotonic() - job_start
+        row = {
+            'instrument': instr,
+            'granularity': gr,
+            'start_date': start_date,
+            'end_date': end_date,
+            'requests': stats['requests'],
+            'candles': stats['candles'],
+            'seconds': seconds,
+            'candles_per_sec': stats['candles'] / seconds if seconds > 0 else 0,
+            'error': error,
+        }
+        
+        # logging our progress
+        with lock:
+            results.append(row)
+            status = 'FAILED ' + error if error else f"{row['candles']} candles, {row['requests']} requests, {row['candles_per_sec']:.0f} candles/s"
+            print(f'[{len(results)}/{len(jobs)}] {instr} {gr} {start_date} - {end_date}: {status} in {seconds:.1f}s')
+            
+        return row
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool, ThreadPoolExecutor(max_workers=max_jobs) as job_pool:
+        rows = list(job_pool.map(run, jobs))
+        
+    total = time.monotonic() - started
+    candles = sum(row['candles'] for row in rows)
+    print(f'Finished {len(rows)} jobs: {candles} candles in {total:.1f}s ({candles / total if total > 0 else 0:.0f} candles/s)')
+    
+    return pd.DataFrame(rows)
@@ -0,0 +1,130 @@
+# Tests of the backtest engines - run with: python -m pytest Model_Z
+import numpy as np
+import pandas as pd
+
+import omega_simulate as osim
+
+
+def parity_sequence():
+    # 40 smooth bars with a '3' change column, like a slice of changes_1hr_USDGBP.csv
+    i = np.arange(40)
+    open_ = np.round(1.3 + 0.01 * np.sin(i / 3) + 0.0005 * i, 5)
+    close = np.round(open_ + 0.002 * np.cos(i / 2), 5)
+
+    sequence = pd.DataFrame({'open': open_, 'close': close})
+    sequence['3'] = (sequence['open'] - sequence['close'].shift(3)) / sequence['close'].shift(3)
+
+    return sequence.fillna(0)
+
+
+def test_simulations_match_the_original_loops():
+    # the returned tuples and trades of the DataFrame-slicing simulations before thresh_trade_engine
+    sequence = parity_sequence()
+    cases = [
+        (osim.simulate_thresh_test_trade_basic, (0.002, 0.002, 1000), (1000, 1034.79601, 3, 0.002, 0.002, '3'), [(0, 1), (8, -1), (14, 1), (26, -1), (32, 1)]),
+        (osim.simulate_thresh_test_trade, (0.002, 0.002, 1000), (1000, 1034.43395, 3, 0.002, 0.002, '3'), [(0, 1), (8, -1), (14, 1), (26, -1), (32, 1)]),
+        (osim.simulate_thresh_test_trade_best, (0.002, 0.002, 1000), (1000, 1013.9609499999998, 1, 0.002, 0.002, '3'), [(0, 1), (8, -1), (14, 1)]),
+        (osim.simulate_thresh_test_trade_simple, (0.002, 1000), (1000, 1038.739035, 3, 0.002, '3'),
+            [(0, 1), (3, -1), (14, 1), (17, -1), (17, 1), (20, -1), (20, 1), (23, -1), (32, 1), (35, -1), (35, 1), (38, -1), (38, 1), (39, -1)]),
+    ]
+
+    for simulate, args, expected, trades in cases:
+        result = simulate(sequence, *args, print_trades=False, return_ledger=True)
+
+        assert result[:-2] == expected, simulate.__name__
+        assert result[-2][['bar', 'side']].tolist() == trades, simulate.__name__
+
+
+def test_engine_rejects_bad_configuration():
+    open_ = np.linspace(1.0, 1.2, 20)
+    signal = np.full(20, 0.1)
+
+    for kwargs in ({'exit_rule': 'bogus'}, {'entry': 'close'}, {'entry': 'mid', 'exit_rule': 'window'}):
+        try:
+            osim.thresh_trade_engine(open_, signal, 3, 0, 0, 1000, **kwargs)
+        except ValueError:
+            continue
+        raise AssertionError(f'{kwargs} was accepted')
+
+
+def test_window_rule_entry_on_last_bar():
+    # every window buys, the last one is clipped to the last bar and bought and sold on it
+    open_ = np.array([1.0, 1.1, 1.2, 1.3])
+    signal = np.full(4, 0.1)
+
+    bc, h, _, _, _, ledger, equity = osim.thresh_trade_engine(open_, signal, 1, 0, 0.5, 1000, close_=open_, entry='mid', exit_rule='window')
+
+    assert ledger[-1]['bar'] == 3 and ledger[-1]['side'] == osim.SELL
+    assert h == 0
+    assert equity[-1] == bc
+    np.testing.assert_allclose(equity, [1000, 1100, 1199.9, 1299.8])
+
+
+def test_cost_model_matches_oanda_cost():
+    units = np.array([0, 1, 6853, 250000])
+
+    np.testing.assert_array_equal(osim.CostModel().costs(units), osim.omega_oanda_core_cost(units))
+    np.testing.assert_array_equal(osim.CostModel(spread=np.full(10, 0.00002)).costs(units, np.array([0, 3, 5, 9])), osim.omega_oanda_core_cost(units))
+    assert osim.CostModel().costs(6853) == osim.omega_oanda_core_cost(6853)
+
+
+def test_cost_model_rejects_short_spread():
+    open_ = np.linspace(1.0, 1.2, 50)
+    signal = np.full(50, 0.1)
+    costs = osim.CostModel(spread=np.full(10, 0.00002))
+
+    for exit_rule in ('signal', 'window'):
+        try:
+            osim.thresh_trade_engine(open_, signal, 3, 0, 0.5, 1000, close_=open_, exit_rule=exit_rule, cost_fn=costs)
+        except ValueError:
+            continue
+        raise AssertionError(f'{exit_rule}: a spread of 10 bars was accepted for 50 bars')
+
+
+def test_margin_high_leverage_losses_bounded():
+    # a random walk without gaps - every bar opens at the previous close
+    rng = np.random.default_rng(0)
+    close = 1.3 * np.exp(np.cumsum(rng.normal(0, 0.002, 2000)))
+    open_ = np.concatenate([[1.3], close[:-1]])
+    low = np.minimum(open_, close) - rng.uniform(0, 0.002, 2000)
+    signal = np.concatenate([close[24:] / close[:-24] - 1, np.zeros(24)])
+
+    buy, sell, leverage = [x.ravel() for x in np.meshgrid([0, 0.002, 0.005], [0, 0.002], [50, 100, 200], indexing='ij')]
+    balance, h, _, min_closeout, equity, _, ledger = osim.margin_trade_batch(open_, signal, 24, buy, sell, leverage, 10000, low_=low, cost_fn=osim.CostModel())
+
+    liquidations = ledger[ledger['side'] == osim.LIQUIDATION]
+    assert len(liquidations)
+    assert (ledger['units'] >= 0).all()
+
+    # liquidated at the closeout price - never below zero without gaps
+    assert (liquidations['capital'] > 0).all()
+    assert (equity > 0).all()
+    assert np.nanmin(min_closeout) >= 0.5 - 1e-9
+
+
+def test_stream_retention_and_live_fills():
+    sequence = parity_sequence()
+    candles = list(zip(sequence['open'], sequence['close'], sequence['3']))
+
+    # replay keeps its ledger, unless the fills are handed on
+    replay = osim.StreamBacktest(3, 0.002, 0.002, 1000)
+    handed = []
+    passed_on = osim.StreamBacktest(3, 0.002, 0.002, 1000, on_fill=handed.append)
+    bounded = osim.StreamBacktest(3, 0.002, 0.002, 1000, keep_fills=2)
+    for backtest in (replay, passed_on, bounded):
+        for candle in candles:
+            backtest.update(*candle)
+        backtest.finish()
+
+    assert replay.ledger()[['bar', 'side']].tolist() == [(0, 1), (8, -1), (14, 1), (26, -1), (32, 1)]
+    assert len(handed) == 5 and len(passed_on.ledger()) == 0
+    assert bounded.ledger()[['bar', 'side', 'price']].tolist() == replay.ledger()[-2:][['bar', 'side', 'price']].tolist()
+
+    # live - the signal given with a candle fills at that candle's open
+    live = osim.StreamBacktest(3, 0.002, 0.002, 1000, live=True)
+    for t, candle in enumerate(candles):
+        for bar, side, price, *_ in live.update(*candle):
+            assert bar == t and price == candle[0]
+            assert (candle[2] >= 0.002) if side == osim.BUY else (candle[2] <= -0.002)
+    assert live.finish() == []
+    assert len(live.ledger())
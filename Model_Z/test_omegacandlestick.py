@@ -0,0 +1,51 @@
+# Tests of the image dataset builders - run with: python -m pytest Model_Z
+import numpy as np
+import pandas as pd
+
+import omegacandlestick as oc
+from omega_shards import open_shards
+
+
+def candles(n=120, seed=0):
+    rng = np.random.default_rng(seed)
+    close = 1.3 * np.exp(np.cumsum(rng.normal(0, 0.002, n)))
+    open_ = np.concatenate([[1.3], close[:-1]])
+
+    return pd.DataFrame({
+        'date': pd.date_range('2018-01-01', periods=n, freq='h'),
+        'open': open_,
+        'high': np.maximum(open_, close) + 0.001,
+        'low': np.minimum(open_, close) - 0.001,
+        'close': close,
+    })
+
+
+def sharded(path):
+    # every window written by every worker, in start order
+    _, labels, index = open_shards(path)
+    order = np.argsort(index)
+
+    return index[order], labels[order]
+
+
+def test_shard_seams_match_unsharded_labels(tmp_path):
+    df = candles()
+    target_size = 3
+
+    # one size - 4 shards
+    oc.generate_images(df, str(tmp_path / 'single'), 0.001, 0.001, window_size=6, target_size=target_size, output='npy', shard_size=32, processes=1, shards=4)
+
+    starts, labels = oc.label_windows(df['open'].values, df['close'].values, 6, target_size, 0.001, 0.001)
+    index, shard_labels = sharded(tmp_path / 'single')
+    np.testing.assert_array_equal(index, starts)
+    np.testing.assert_array_equal(shard_labels, labels)
+
+    # several sizes - sharded by the largest, 5 shards
+    sizes = [3, 6, 24]
+    oc.generate_images(df, str(tmp_path / 'sizes'), 0.001, 0.001, window_size=sizes, target_size=target_size, output='npy', shard_size=32, processes=1, shards=5)
+
+    for window_size in sizes:
+        starts, labels = oc.label_windows(df['open'].values, df['close'].values, window_size, target_size, 0.001, 0.001)
+        index, shard_labels = sharded(tmp_path / 'sizes' / f'W{window_size}')
+        np.testing.assert_array_equal(index, starts)
+        np.testing.assert_array_equal(shard_labels, labels)